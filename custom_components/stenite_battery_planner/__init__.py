@@ -1,30 +1,73 @@
 # custom_components/stenite_battery_planner/__init__.py
 from __future__ import annotations
 
+import asyncio
 import logging
-from datetime import timedelta
-from typing import Any, Dict, Optional
+import os
+from datetime import datetime, timedelta
+from time import perf_counter
+from typing import Any, Dict, List, Optional, Tuple
 
 import voluptuous as vol
 import aiohttp
 from homeassistant.config_entries import ConfigEntry
 
-from homeassistant.core import HomeAssistant, ServiceCall, ServiceResponse, SupportsResponse
+from homeassistant.core import (
+    CALLBACK_TYPE,
+    Event,
+    HomeAssistant,
+    ServiceCall,
+    ServiceResponse,
+    SupportsResponse,
+    callback,
+)
 from homeassistant.helpers import config_validation as cv
 from homeassistant.helpers.aiohttp_client import async_get_clientsession
 from homeassistant.helpers.entity_platform import AddEntitiesCallback
 from homeassistant.helpers.typing import ConfigType, DiscoveryInfoType
 from homeassistant.helpers.update_coordinator import (
     DataUpdateCoordinator,
+    UpdateFailed,
 )
+from homeassistant.helpers.event import async_track_state_change_event, async_track_time_change
+from homeassistant.helpers.storage import Store
+from homeassistant.util import dt as dt_util
 from homeassistant.const import CONF_NAME
 
+from .loads import MEASURED_UNITS, LoadProgress, co_optimize, deferrable_energy, parse_loads
+from .models import Plan, PlanParseError, decode_plan, parse_plan
+from .planner import expected_terminal, extend, parse_curve, schedule, shadow_prices, solve
+from .profiling import RefreshProfiler
+from .scenarios import PriceStatistics, generate_scenarios, unpublished_slots
+from .tariff import MonthlyPeak, TimeOfUseTariff, parse_tariff
+from .traffic import TRAFFIC_MODES, TrafficRecorder, TrafficReplay, load_traffic
+
 DOMAIN = "stenite_battery_planner"
 _LOGGER = logging.getLogger(__name__)
 
 # Default values
 DEFAULT_NAME = "Battery Planner"
 DEFAULT_BATTERY_ALLOW_EXPORT = False
+DEFAULT_SCENARIO_COUNT = 50
+
+PLANNER_API_ENDPOINT = "https://batteryplanner.stenite.com/api/v2.0/plan"
+
+PLANNING_MODES = ["api", "local", "stochastic"]
+
+PLATFORMS = ["number", "select", "sensor", "calendar"]
+
+# Day-ahead prices are published around 13:00, poll for them every few
+# minutes until they show up in the plan
+PUBLICATION_HOURS = [12, 13, 14]
+PUBLICATION_POLL_MINUTES = 2
+
+STORAGE_VERSION = 1
+STORAGE_KEY_PRICE_STATISTICS = f"{DOMAIN}.price_statistics"
+STORAGE_KEY_MONTHLY_PEAK = f"{DOMAIN}.monthly_peak"
+
+# Default traffic log, relative to the Home Assistant config directory
+TRAFFIC_LOG_FILE = f"{DOMAIN}_traffic.jsonl.gz"
+TRAFFIC_LOG_SUFFIX = ".jsonl.gz"
 
 # Configuration schema
 CONFIG_SCHEMA = vol.Schema({
@@ -80,6 +123,39 @@ CONFIG_SCHEMA = vol.Schema({
             vol.Coerce(float),
             lambda v: validate_positive_float(v, "stored_value_per_kWh")
         ),
+        vol.Optional("auto_stored_value", default=False): cv.boolean,
+        vol.Optional("planning_mode", default="api"): vol.In(PLANNING_MODES),
+        vol.Optional("scenario_count", default=DEFAULT_SCENARIO_COUNT): vol.All(
+            vol.Coerce(int), vol.Range(min=1, max=500)
+        ),
+        vol.Optional("charge_efficiency_curve", default=""): vol.All(
+            cv.string,
+            lambda v: validate_curve(v, "charge_efficiency_curve")
+        ),
+        vol.Optional("discharge_efficiency_curve", default=""): vol.All(
+            cv.string,
+            lambda v: validate_curve(v, "discharge_efficiency_curve")
+        ),
+        vol.Optional("soc_efficiency_curve", default=""): vol.All(
+            cv.string,
+            lambda v: validate_curve(v, "soc_efficiency_curve")
+        ),
+        vol.Optional("dod_wear_exponent", default=1.0): vol.All(
+            vol.Coerce(float), vol.Range(min=1, max=5)
+        ),
+        vol.Optional("tariff_rates", default=""): vol.All(
+            cv.string,
+            lambda v: validate_tariff(v, "tariff_rates")
+        ),
+        vol.Optional("peak_power_fee", default=0.0): vol.All(
+            vol.Coerce(float),
+            lambda v: validate_positive_or_zero_float(v, "peak_power_fee")
+        ),
+        vol.Optional("grid_import_entity", default=""): vol.Any("", cv.entity_id),
+        vol.Optional("flexible_loads", default=""): vol.All(
+            cv.string,
+            lambda v: validate_loads(v, "flexible_loads")
+        ),
     })
 }, extra=vol.ALLOW_EXTRA)
 
@@ -98,6 +174,32 @@ def validate_positive_or_zero_float(value: float, name: str) -> None:
         raise vol.Invalid(f"{name} must be greater or equal to 0")
     return float(value)
 
+def validate_curve(value: str, name: str) -> str:
+    """Validate an ``x:y, x:y`` efficiency curve with y values in (0, 1]."""
+    try:
+        points = parse_curve(value)
+    except ValueError as err:
+        raise vol.Invalid(f"{name} must be a list of x:y points") from err
+    if any(not 0 < y <= 1 for _, y in points):
+        raise vol.Invalid(f"{name} values must be greater than 0 and at most 1")
+    return value or ""
+
+def validate_tariff(value: str, name: str) -> str:
+    """Validate a ``days start-end:rate, ...`` time-of-use rate table."""
+    try:
+        parse_tariff(value)
+    except ValueError as err:
+        raise vol.Invalid(f"{name} must be a list of 'days start-end:rate' rules") from err
+    return value or ""
+
+def validate_loads(value: str, name: str) -> str:
+    """Validate a ``name energy min-max HH:MM [entity], ...`` list of flexible loads."""
+    try:
+        parse_loads(value)
+    except ValueError as err:
+        raise vol.Invalid(f"{name} must be a list of 'name energy min-max HH:MM [entity]' loads") from err
+    return value or ""
+
 def validate_percentage(value: float, name: str) -> None:
     """Validate that a value is a percentage (0-100)."""
     if not isinstance(value, (int, float)):
@@ -160,6 +262,19 @@ CALL_SERVICE_SCHEMA = vol.Schema({
     ),
 })
 
+PROFILE_SERVICE_SCHEMA = vol.Schema({
+    vol.Optional('enable'): cv.boolean,
+    vol.Optional('reset', default=False): cv.boolean,
+    vol.Optional('capture_refresh', default=False): cv.boolean,
+    vol.Optional('top', default=20): vol.All(vol.Coerce(int), vol.Range(min=1, max=200)),
+})
+
+TRAFFIC_SERVICE_SCHEMA = vol.Schema({
+    vol.Optional('mode'): vol.In(TRAFFIC_MODES),
+    vol.Optional('path'): cv.string,
+    vol.Optional('latency_scale', default=1.0): vol.All(vol.Coerce(float), vol.Range(min=0)),
+})
+
 PLANNER_API_PARAM_ID = [
     'nordpool_area',
     'mean_draw',
@@ -177,6 +292,21 @@ PLANNER_API_PARAM_ID = [
     'stored_value_per_kWh',
 ]
 
+# Parameters only used by the local planning engine, never sent to the API
+PLANNER_LOCAL_PARAM_ID = [
+    'auto_stored_value',
+    'planning_mode',
+    'scenario_count',
+    'charge_efficiency_curve',
+    'discharge_efficiency_curve',
+    'soc_efficiency_curve',
+    'dod_wear_exponent',
+    'tariff_rates',
+    'peak_power_fee',
+    'grid_import_entity',
+    'flexible_loads',
+]
+
 PLANNER_INPUT_PARAMS = [
     {"api_id": 'nordpool_area', "id": 'nordpool_area', "name": 'Nordpool Area', "entity_type": 'option', "options": ["SE1", "SE2", "SE3", "SE4"]},
     {"api_id": None, "id": 'currency', "name": 'Nordpool Currency', "entity_type": 'option', "options": ["SEK", "SEK2", "SEK3", "SEK4"]},
@@ -198,11 +328,11 @@ PLANNER_INPUT_PARAMS = [
 async def async_setup_entry(hass: HomeAssistant, entry: ConfigEntry) -> bool:
     """Set up Stenite Battery Planner from a config entry."""
     coordinator = BatteryPlannerCoordinator(hass, entry.data[CONF_NAME])
+    await coordinator.async_load_stored_data()
 
-    # Initialize coordinator parameters with config values
-    for param in PLANNER_API_PARAM_ID:
-        if param in entry.data:
-            await coordinator.set_param(param, entry.data[param])
+    # Initialize coordinator parameters with config values, the first refresh
+    # below plans with all of them at once
+    await coordinator.async_set_params(_entry_params(entry), refresh=False)
 
     # Store coordinator in hass.data using the entry_id
     hass.data.setdefault(DOMAIN, {})[entry.entry_id] = coordinator
@@ -210,7 +340,16 @@ async def async_setup_entry(hass: HomeAssistant, entry: ConfigEntry) -> bool:
     # Perform initial data fetch
     await coordinator.async_config_entry_first_refresh()
 
-    await hass.config_entries.async_forward_entry_setups(entry, ["number", "select", "sensor"])
+    # Apply option changes to the live coordinator instead of reloading
+    entry.async_on_unload(entry.add_update_listener(async_update_options))
+
+    # Replan as soon as the next day's prices are published
+    entry.async_on_unload(coordinator.async_track_publication())
+
+    # Follow the measured grid import for the monthly peak, if configured
+    entry.async_on_unload(coordinator.async_track_grid_import())
+
+    await hass.config_entries.async_forward_entry_setups(entry, PLATFORMS)
 
     # Only register service if it hasn't been registered yet
     if not hass.services.has_service(DOMAIN, 'plan'):
@@ -219,23 +358,18 @@ async def async_setup_entry(hass: HomeAssistant, entry: ConfigEntry) -> bool:
             # Get the coordinator for this instance
             coordinator = next(iter(hass.data[DOMAIN].values()))
 
-            # Build payload from current parameter values
-            payload = {}
-            for param in PLANNER_API_PARAM_ID:
-                if param in call.data:
-                    # Update coordinator with new value from service call
-                    await coordinator.set_param(param, call.data[param])
-                payload[param] = await coordinator.get_param_value(param)
-
-            await coordinator.validate_dependent_values(payload)
-            coordinator.endpoint = "https://batteryplanner.stenite.com/api/v2.0/plan"
-            coordinator.payload = payload
+            # Validate the service values against the current parameters
+            # before applying any of them
+            updates = {param: call.data[param] for param in PLANNER_API_PARAM_ID if param in call.data}
+            await coordinator.validate_dependent_values({**coordinator.params, **updates})
 
-            # Trigger an immediate data update
-            await coordinator.async_refresh()
+            # Apply all values at once and replan. Concurrent refreshes are
+            # serialized by the coordinator, so the plan returned below was
+            # computed from these values or newer ones.
+            await coordinator.async_set_params(updates)
 
             # Return the plan data
-            return coordinator.data if coordinator.data else {"error": "Failed to fetch plan"}
+            return coordinator.data.as_dict() if coordinator.data else {"error": "Failed to fetch plan"}
 
         hass.services.async_register(
             DOMAIN,
@@ -248,23 +382,10 @@ async def async_setup_entry(hass: HomeAssistant, entry: ConfigEntry) -> bool:
     async def get_schedule(call: ServiceCall) -> ServiceResponse:
         """Handle retrieving the current schedule."""
         coordinator = next(iter(hass.data[DOMAIN].values()))
-        if not coordinator.data or "schedule" not in coordinator.data:
+        if not coordinator.data:
             return {"schedule": []}
 
-        schedule = coordinator.data.get("schedule", [])
-        formatted_schedule = []
-
-        for period in schedule:
-            formatted_schedule.append({
-                "start_time": period.get("start_time"),
-                "end_time": period.get("end_time"),
-                "action": period.get("action"),
-                "power": period.get("power"),
-                "price": period.get("price"),
-                "savings": period.get("savings")
-            })
-
-        return {"schedule": formatted_schedule}
+        return {"schedule": coordinator.data.schedule.periods()}
 
     # Register the get_schedule service
     hass.services.async_register(
@@ -274,12 +395,124 @@ async def async_setup_entry(hass: HomeAssistant, entry: ConfigEntry) -> bool:
         supports_response=SupportsResponse.ONLY,
     )
 
+    async def get_stored_energy_value(call: ServiceCall) -> ServiceResponse:
+        """Handle retrieving the marginal value of stored energy per slot."""
+        coordinator = next(iter(hass.data[DOMAIN].values()))
+        return {"forecast": coordinator.stored_energy_value}
+
+    # Register the get_stored_energy_value service
+    hass.services.async_register(
+        DOMAIN,
+        "get_stored_energy_value",
+        get_stored_energy_value,
+        supports_response=SupportsResponse.ONLY,
+    )
+
+    async def profile(call: ServiceCall) -> ServiceResponse:
+        """Handle toggling refresh profiling and returning its results."""
+        coordinator = next(iter(hass.data[DOMAIN].values()))
+        profiler = coordinator.profiler
+
+        if call.data.get("reset"):
+            profiler.reset()
+        if "enable" in call.data:
+            profiler.enabled = call.data["enable"]
+
+        if call.data.get("capture_refresh"):
+            with profiler.capture(call.data["top"]):
+                with profiler.span("refresh"):
+                    await coordinator.async_refresh()
+
+        return profiler.summary()
+
+    # Register the profile service
+    hass.services.async_register(
+        DOMAIN,
+        "profile",
+        profile,
+        schema=PROFILE_SERVICE_SCHEMA,
+        supports_response=SupportsResponse.ONLY,
+    )
+
+    async def traffic(call: ServiceCall) -> ServiceResponse:
+        """Handle switching planner API recording and replay."""
+        coordinator = next(iter(hass.data[DOMAIN].values()))
+
+        if "mode" in call.data:
+            path = _traffic_log_path(hass, call.data.get("path") or TRAFFIC_LOG_FILE)
+            await coordinator.async_set_traffic_mode(call.data["mode"], path, call.data["latency_scale"])
+
+        return coordinator.traffic_status()
+
+    # Register the traffic service
+    hass.services.async_register(
+        DOMAIN,
+        "traffic",
+        traffic,
+        schema=TRAFFIC_SERVICE_SCHEMA,
+        supports_response=SupportsResponse.ONLY,
+    )
+
     return True
 
 
+def _traffic_log_path(hass: HomeAssistant, path: str) -> str:
+    """Resolve a traffic log path, relative to the config directory.
+
+    Only ``.jsonl.gz`` files inside the config directory or an allowlisted
+    external directory are accepted, so the service cannot be used to read
+    or append to other files.
+    """
+    resolved = os.path.realpath(hass.config.path(path))
+    config_dir = os.path.realpath(hass.config.config_dir)
+    if not resolved.endswith(TRAFFIC_LOG_SUFFIX):
+        raise vol.Invalid(f"Traffic log must be a {TRAFFIC_LOG_SUFFIX} file")
+    if os.path.commonpath([resolved, config_dir]) != config_dir and not hass.config.is_allowed_path(resolved):
+        raise vol.Invalid(f"Traffic log {path} is outside the config directory and allowed external directories")
+    return resolved
+
+
+def _entry_params(entry: ConfigEntry) -> Dict[str, Any]:
+    """Return the planner parameters stored in a config entry."""
+    return {
+        param: entry.data[param]
+        for param in PLANNER_API_PARAM_ID + PLANNER_LOCAL_PARAM_ID
+        if param in entry.data
+    }
+
+
+async def async_update_options(hass: HomeAssistant, entry: ConfigEntry) -> None:
+    """Apply only the changed parameters of an updated entry with a single replan."""
+    coordinator = hass.data[DOMAIN].get(entry.entry_id)
+    if coordinator is None:
+        return
+
+    changed = {
+        param: value
+        for param, value in _entry_params(entry).items()
+        if coordinator.params.get(param) != value
+    }
+    if "flexible_loads" in changed and (
+            [load[0] for load in parse_loads(changed["flexible_loads"])]
+            != [load[0] for load in parse_loads(coordinator.params["flexible_loads"])]
+    ):
+        # Every load has its own entity, so adding or removing one needs a reload
+        await hass.config_entries.async_reload(entry.entry_id)
+        return
+
+    if "grid_import_entity" in changed:
+        # The state listener is set up with the entry
+        await hass.config_entries.async_reload(entry.entry_id)
+        return
+
+    if changed:
+        _LOGGER.debug(f"Applying changed options without reload: {changed}")
+        await coordinator.async_set_params(changed)
+
+
 async def async_unload_entry(hass: HomeAssistant, entry: ConfigEntry) -> bool:
     """Unload a config entry."""
-    unload_ok = await hass.config_entries.async_forward_entry_unload(entry, ["number", "select", "sensor"])
+    unload_ok = await hass.config_entries.async_forward_entry_unload(entry, PLATFORMS)
     if unload_ok:
         hass.data[DOMAIN].pop(entry.entry_id)
 
@@ -300,9 +533,26 @@ class BatteryPlannerCoordinator(DataUpdateCoordinator):
             _LOGGER,
             name=f"{name} Coordinator",
             update_interval=timedelta(minutes=5),
+            # Callers joining the same request get the same plan object, so
+            # listeners are only notified once per plan
+            always_update=False,
         )
-        self.endpoint: Optional[str] = "https://batteryplanner.stenite.com/api/v2.0/plan"
+        self.endpoint: Optional[str] = PLANNER_API_ENDPOINT
         self.payload: Dict[str, Any] = {}
+        self.profiler = RefreshProfiler()
+
+        # Planner API traffic is either sent as is, recorded or replayed
+        self.traffic_mode = "off"
+        self.traffic_path: Optional[str] = None
+        self._recorder: Optional[TrafficRecorder] = None
+        self._replay: Optional[TrafficReplay] = None
+
+        # Single-flight state: the running planning request, the inputs it
+        # was started with and at most one queued follow-up request
+        self._inflight: Optional[asyncio.Task] = None
+        self._inflight_key: Optional[tuple] = None
+        self._followup: Optional[asyncio.Task] = None
+        self.stored_energy_value: List[Dict[str, Any]] = []
 
         # Input parameters with default values
         self._params = {
@@ -320,45 +570,453 @@ class BatteryPlannerCoordinator(DataUpdateCoordinator):
             "battery_cycle_cost": 0.0,
             "network_charge_kWh": 0.0,
             "stored_value_per_kWh": 0.0,
+            "auto_stored_value": False,
+            "planning_mode": "api",
+            "scenario_count": DEFAULT_SCENARIO_COUNT,
+            "charge_efficiency_curve": "",
+            "discharge_efficiency_curve": "",
+            "soc_efficiency_curve": "",
+            "dod_wear_exponent": 1.0,
+            "tariff_rates": "",
+            "peak_power_fee": 0.0,
+            "grid_import_entity": "",
+            "flexible_loads": "",
         }
 
-    async def _async_update_data(self) -> Dict[str, Any]:
-        """Fetch data from endpoint."""
+        self._local_plan: Optional[Dict[str, Any]] = None
+        self.price_statistics = PriceStatistics()
+        self._statistics_store = Store(hass, STORAGE_VERSION, STORAGE_KEY_PRICE_STATISTICS)
+        self.monthly_peak = MonthlyPeak()
+        self._peak_store = Store(hass, STORAGE_VERSION, STORAGE_KEY_MONTHLY_PEAK)
+        self._tariff: Optional[TimeOfUseTariff] = None
+        self._tariff_key: Optional[tuple] = None
+        self._load_progress = LoadProgress()
+        self._load_shortfalls: Dict[str, datetime] = {}
+        self.load_schedules: Dict[str, Dict[str, Any]] = {}
+
+    async def async_load_stored_data(self) -> None:
+        """Load the price statistics and monthly peak saved by earlier runs."""
+        stored = await self._statistics_store.async_load()
+        if stored:
+            self.price_statistics = PriceStatistics(stored)
+        stored = await self._peak_store.async_load()
+        if stored:
+            self.monthly_peak = MonthlyPeak(stored)
+
+    def _current_tariff(self) -> TimeOfUseTariff:
+        """Return the tariff for the current parameters, rebuilt only when they change."""
+        key = (self._params["tariff_rates"], self._params["network_charge_kWh"])
+        if self._tariff is None or key != self._tariff_key:
+            self._tariff = TimeOfUseTariff(
+                parse_tariff(self._params["tariff_rates"]),
+                float(self._params["network_charge_kWh"]),
+                dt_util.DEFAULT_TIME_ZONE,
+            )
+            self._tariff_key = key
+        return self._tariff
+
+    def _observe_import(self, plan: Plan) -> None:
+        """Track the month's peak grid import from the recommended action.
+
+        Only used without a measured grid import entity. Planned imports are
+        averages over a period, so this underestimates the real peak.
+        """
+        if self._params["grid_import_entity"]:
+            return
+        power = float(self._params["mean_draw"])
+        if plan.action_type == "charge":
+            power += plan.watts / 1000
+        elif plan.action_type in ("discharge", "self_consumption"):
+            power -= plan.watts / 1000
+        power += sum(load["power"] for load in self.load_schedules.values())
+        if self.monthly_peak.observe(dt_util.now(), power):
+            self._peak_store.async_delay_save(self.monthly_peak.as_dict, 60)
+
+    async def _async_update_data(self) -> Optional[Plan]:
+        """Fetch data from endpoint, sharing requests with concurrent refreshes."""
+        return await self._async_plan_single_flight()
+
+    def _inputs_key(self) -> tuple:
+        """Return a hashable snapshot of the planning inputs."""
+        return tuple(self._params[param] for param in PLANNER_API_PARAM_ID + PLANNER_LOCAL_PARAM_ID)
+
+    async def _async_plan_single_flight(self) -> Optional[Plan]:
+        """Plan with the current inputs, at most one request at a time.
+
+        A caller whose inputs match the running request joins it. Otherwise
+        exactly one follow-up is queued behind it; every caller with changed
+        inputs shares that follow-up, which reads the inputs when it starts
+        and therefore reflects all of their changes. A queued follow-up is
+        joined even after the running request has finished, because it only
+        starts its own request on a later loop iteration.
+        """
+        inflight = self._inflight
+        running = inflight is not None and not inflight.done()
+        if running and self._inputs_key() == self._inflight_key:
+            self.profiler.count("joined_requests")
+            return await asyncio.shield(inflight)
+        if self._followup is not None:
+            self.profiler.count("queued_requests")
+            return await asyncio.shield(self._followup)
+        if running:
+            self._followup = self.hass.async_create_task(self._async_follow_up(inflight))
+            self.profiler.count("queued_requests")
+            return await asyncio.shield(self._followup)
+        return await asyncio.shield(self._async_start_flight())
+
+    def _async_start_flight(self) -> asyncio.Task:
+        """Start a planning request with the current inputs."""
+        self._inflight_key = self._inputs_key()
+        self._inflight = self.hass.async_create_task(self._async_fetch_plan())
+        return self._inflight
+
+    async def _async_follow_up(self, previous: asyncio.Task) -> Optional[Plan]:
+        """Run the queued request once the running one has finished."""
+        await asyncio.wait([previous])
+        # Register the new request before callers stop joining the follow-up,
+        # so no caller can start a request of its own in between
+        flight = self._async_start_flight()
+        self._followup = None
+        return await flight
+
+    async def _async_fetch_plan(self) -> Optional[Plan]:
+        """Fetch a plan from the endpoint."""
         if not self.endpoint:
-            return {}
+            return None
 
         # Build payload from current parameter values
-        self.payload = {param: self._params[param] for param in PLANNER_API_PARAM_ID}
+        with self.profiler.span("build_payload"):
+            self.payload = {param: self._params[param] for param in PLANNER_API_PARAM_ID}
 
         try:
-            session = async_get_clientsession(self.hass)
             _LOGGER.debug(f"Planning request with payload: {self.payload}")
 
-            async with session.post(
-                    self.endpoint,
-                    json=self.payload
-            ) as response:
-                if response.status == 200:
-                    return await response.json()
-                else:
-                    error_text = await response.text()
-                    _LOGGER.error(f"Battery planning failed with status {response.status}: {error_text}")
-                    return {}
+            with self.profiler.span("http_wait"):
+                status, body = await self._async_post(self.payload)
+            self.profiler.count("requests")
+            self.profiler.count("response_bytes", len(body))
+
+            if status == 200:
+                with self.profiler.span("json_decode"):
+                    plan = decode_plan(body)
+                return await self._async_plan_locally(plan)
+            else:
+                error_text = body.decode(errors="replace")
+                _LOGGER.error(f"Battery planning failed with status {status}: {error_text}")
+                return None
+        except PlanParseError as e:
+            # Keep the last valid plan rather than publishing a broken one
+            raise UpdateFailed(f"Malformed battery plan: {e}") from e
         except Exception as e:
             _LOGGER.error(f"Error in battery planning: {e}")
-            return {}
+            return None
+
+    async def _async_post(self, payload: Dict[str, Any]) -> Tuple[int, bytes]:
+        """Send a planning request, or answer it from the replayed traffic log."""
+        if self._replay is not None:
+            status, body, delay = self._replay.response(payload)
+            await asyncio.sleep(delay)
+            return status, body
+
+        session = async_get_clientsession(self.hass)
+        start = perf_counter()
+        async with session.post(self.endpoint, json=payload) as response:
+            body = await response.read()
+        elapsed = perf_counter() - start
+
+        if self._recorder is not None:
+            try:
+                await self.hass.async_add_executor_job(
+                    self._recorder.append, dt_util.now(), payload, response.status, body, elapsed
+                )
+            except OSError as e:
+                _LOGGER.error(f"Error recording planner traffic: {e}")
+        return response.status, body
+
+    async def async_set_traffic_mode(self, mode: str, path: str, latency_scale: float = 1.0) -> None:
+        """Switch between sending, recording and replaying planner API traffic."""
+        replay = None
+        if mode == "replay":
+            try:
+                entries = await self.hass.async_add_executor_job(load_traffic, path)
+                replay = TrafficReplay(entries, latency_scale)
+            except (OSError, ValueError) as err:
+                raise vol.Invalid(f"Cannot replay traffic log {path}: {err}") from err
+
+        self.traffic_mode = mode
+        self.traffic_path = path if mode != "off" else None
+        self._recorder = TrafficRecorder(path) if mode == "record" else None
+        self._replay = replay
+
+    def traffic_status(self) -> Dict[str, Any]:
+        """Return the traffic mode with its recording or replay counters."""
+        status: Dict[str, Any] = {"mode": self.traffic_mode, "path": self.traffic_path}
+        if self._recorder is not None:
+            status["recorded"] = self._recorder.recorded
+        if self._replay is not None:
+            status.update(latency_scale=self._replay.latency_scale, **self._replay.summary())
+        return status
+
+    async def _async_plan_locally(self, plan: Plan) -> Plan:
+        """Run the local planning engine over the prices of an API plan.
+
+        Always derives the marginal value of stored energy. In local mode the
+        API schedule is replaced by the local plan, which follows the tariff,
+        peak fee, efficiency and wear models the API does not know about. In
+        stochastic mode it is replaced by a plan that optimizes the expected
+        cost over price scenarios for the part of the next day not yet
+        published. With flexible loads configured it is replaced by a plan
+        that schedules the loads together with the battery.
+        """
+        now = dt_util.now()
+        params = {param: self._params[param] for param in PLANNER_API_PARAM_ID + PLANNER_LOCAL_PARAM_ID}
+        params["monthly_peak"] = self.monthly_peak.current(now)
+        area = self._params["nordpool_area"]
+        stochastic = self._params["planning_mode"] == "stochastic"
+        local = self._params["planning_mode"] == "local"
+        definitions = parse_loads(self._params["flexible_loads"])
+        loads = self._load_progress.requests(
+            definitions, now, dt_util.DEFAULT_TIME_ZONE, self._load_readings(definitions)
+        )
+
+        # Replayed plans must not change what production planning learns
+        replaying = self._replay is not None
+
+        try:
+            slots = plan.schedule.slots()
+            if not replaying and self.price_statistics.record(area, slots):
+                self._statistics_store.async_delay_save(self.price_statistics.as_dict, 60)
+
+            tariff = self._current_tariff()
+            rates = tariff.slot_rates(slots)
+
+            scenarios = []
+            future_hours = []
+            future_rates = []
+            if stochastic:
+                future = unpublished_slots(slots)
+                future_hours = [(end - start).total_seconds() / 3600 for start, end in future]
+                future_rates = tariff.slot_rates(future)
+                scenarios = generate_scenarios(
+                    self.price_statistics,
+                    area,
+                    slots,
+                    future,
+                    int(self._params["scenario_count"]),
+                    seed=int(slots[-1][1].timestamp()) if slots else None,
+                )
+
+            # Load schedules change as energy is delivered, so they are always
+            # solved over the whole horizon
+            previous = None if loads else self._local_plan if self._can_extend_local_plan(params, slots) else None
+            with self.profiler.span("local_planning"):
+                result = await self.hass.async_add_executor_job(
+                    self._solve_local_plan, params, slots, rates, future_hours, future_rates, scenarios, previous, loads
+                )
+            if previous is not None:
+                self.profiler.count("extended_plans")
+                _LOGGER.debug(f"Extended plan to {slots[-1][1]}, {result['reused']} periods were already planned")
+            self._local_plan = {"params": params, "slots": slots, "result": result}
+            self.stored_energy_value = shadow_prices(params, slots, result)
+            self._update_load_schedules(loads, slots, result.get("loads", {}))
+        except Exception as e:
+            _LOGGER.error(f"Error in local battery planning: {e}")
+            self.stored_energy_value = []
+            self.load_schedules = {}
+            return plan
+
+        if self._params["auto_stored_value"] and self.stored_energy_value:
+            # Feed the average marginal value back as the value of energy left
+            # at the end of the horizon for the next planning request
+            values = [slot["value"] for slot in self.stored_energy_value]
+            self._params["stored_value_per_kWh"] = round(max(sum(values) / len(values), 0.0), 4)
+
+        if stochastic and slots:
+            plan = parse_plan({**plan.as_dict(), **schedule(params, slots, result), "scenarios": len(scenarios)})
+        elif (local or loads) and slots:
+            plan = parse_plan({**plan.as_dict(), **schedule(params, slots, result)})
+        if not replaying:
+            self._observe_import(plan)
+        return plan
+
+    def _can_extend_local_plan(self, params: Dict[str, Any], slots: List[Any]) -> bool:
+        """Return whether the last local plan can be extended to the given slots."""
+        previous = self._local_plan
+        if previous is None or not slots or not previous["slots"]:
+            return False
+        if slots[-1][1] <= previous["slots"][-1][1]:
+            return False
+        # The lookup tables cover every SOC level and do not depend on the
+        # terminal value, so neither a SOC change nor a derived stored value
+        # invalidates them.
+        ignored = {"battery_soc"}
+        if params["auto_stored_value"]:
+            ignored.add("stored_value_per_kWh")
+        if not float(params["peak_power_fee"] or 0.0):
+            # Without a fee the month's peak does not enter the plan
+            ignored.add("monthly_peak")
+        return all(
+            previous["params"].get(param) == value
+            for param, value in params.items()
+            if param not in ignored
+        )
+
+    @staticmethod
+    def _solve_local_plan(
+            params: Dict[str, Any],
+            slots: List[Any],
+            rates: List[float],
+            future_hours: List[float],
+            future_rates: List[float],
+            scenarios: List[List[float]],
+            previous: Optional[Dict[str, Any]] = None,
+            loads: Optional[List[Any]] = None,
+    ) -> Dict[str, Any]:
+        """Solve the published horizon against the expected value of the scenarios."""
+        terminal = expected_terminal(params, future_hours, scenarios, future_rates) if scenarios else None
+        if loads:
+            return co_optimize(params, slots, loads, rates, terminal)
+        if previous is not None:
+            return extend(params, previous["slots"], slots, terminal, rates)
+        return solve(params, slots, terminal, rates)
+
+    def _update_load_schedules(
+            self,
+            loads: List[Any],
+            slots: List[Any],
+            powers: Dict[str, List[float]],
+    ) -> None:
+        """Publish the schedule of every flexible load and track its delivery.
+
+        Warns once per deadline about a load whose energy does not fit before
+        its deadline, counting what can still run after the planned horizon.
+        """
+        schedules = {}
+        for request in loads:
+            name, energy, _, _, deadline = request
+            power = powers.get(name) or [0.0] * len(slots)
+            current = power[0] if power else 0.0
+            self._load_progress.set_power(name, current)
+            planned = sum(
+                value * (end - start).total_seconds() / 3600 for (start, end, _), value in zip(slots, power)
+            )
+            deferred = min(deferrable_energy(request, slots[-1][1]), energy) if slots else 0.0
+            shortfall = max(energy - planned - deferred, 0.0)
+            if shortfall > 0.01 and self._load_shortfalls.get(name) != deadline:
+                self._load_shortfalls[name] = deadline
+                _LOGGER.warning(
+                    f"Flexible load {name} needs {energy:.2f} kWh by {deadline.isoformat()} "
+                    f"but only {planned + deferred:.2f} kWh fit in the periods before it"
+                )
+            schedules[name] = {
+                "power": round(current, 3),
+                "energy_remaining": round(energy, 3),
+                "deferred": round(deferred, 3),
+                "shortfall": round(shortfall, 3),
+                "delivered": round(self._load_progress.delivered(name), 3),
+                "deadline": deadline.isoformat(),
+                "schedule": [
+                    {"start_time": start.isoformat(), "end_time": end.isoformat(), "power": round(value, 3)}
+                    for (start, end, _), value in zip(slots, power)
+                    if value > 0
+                ],
+            }
+        self.load_schedules = schedules
+
+    def _load_readings(self, loads: List[Any]) -> Dict[str, Tuple[str, float]]:
+        """Read the energy or power sensor of every flexible load that has one."""
+        readings = {}
+        for name, _, _, _, _, entity_id in loads:
+            if not entity_id:
+                continue
+            state = self.hass.states.get(entity_id)
+            if state is None:
+                continue
+            unit = MEASURED_UNITS.get(state.attributes.get("unit_of_measurement"))
+            if unit is None:
+                _LOGGER.debug(f"Ignoring {entity_id}: not a power or energy sensor")
+                continue
+            try:
+                readings[name] = (unit[0], float(state.state) * unit[1])
+            except ValueError:
+                continue
+        return readings
+
+    @callback
+    def async_track_grid_import(self) -> CALLBACK_TYPE:
+        """Track the month's peak from the configured grid import power entity.
+
+        Returns a callback that stops the tracking.
+        """
+        entity_id = self._params["grid_import_entity"]
+        if not entity_id:
+            return lambda: None
+        return async_track_state_change_event(self.hass, [entity_id], self._async_grid_import_changed)
+
+    @callback
+    def _async_grid_import_changed(self, event: Event) -> None:
+        """Record a new grid import power reading in W or kW."""
+        state = event.data.get("new_state")
+        if state is None:
+            return
+        try:
+            power = float(state.state)
+        except ValueError:
+            return
+        if state.attributes.get("unit_of_measurement") == "W":
+            power /= 1000
+        if self.monthly_peak.observe(dt_util.now(), power):
+            self._peak_store.async_delay_save(self.monthly_peak.as_dict, 60)
+
+    @callback
+    def async_track_publication(self) -> CALLBACK_TYPE:
+        """Poll for the next day's prices around their daily publication.
+
+        Returns a callback that stops the polling.
+        """
+        return async_track_time_change(
+            self.hass,
+            self._async_check_publication,
+            hour=PUBLICATION_HOURS,
+            minute=list(range(0, 60, PUBLICATION_POLL_MINUTES)),
+            second=0,
+        )
+
+    async def _async_check_publication(self, now: datetime) -> None:
+        """Replan right away unless the plan already covers the next day."""
+        if self._local_plan is not None and self._local_plan["slots"]:
+            tomorrow = dt_util.start_of_local_day(now) + timedelta(days=1)
+            horizon_end = self._local_plan["slots"][-1][1]
+            if horizon_end.tzinfo is None:
+                horizon_end = horizon_end.replace(tzinfo=dt_util.DEFAULT_TIME_ZONE)
+            if horizon_end > tomorrow:
+                return
+        await self.async_request_refresh()
 
     async def set_param(self, param: str, value) -> Any:
         """Set parameter value and trigger update."""
         try:
             self._params[param] = value
             # Schedule an update when parameters change
-            await self.async_refresh()
+            with self.profiler.span("set_param"):
+                await self.async_refresh()
             return self._params[param]
         except Exception as e:
             _LOGGER.error(f"Error when setting planning parameter: {e}")
             return None
 
+    async def async_set_params(self, values: Dict[str, Any], refresh: bool = True) -> None:
+        """Set several parameter values and replan once."""
+        self._params.update(values)
+        if refresh:
+            with self.profiler.span("set_param"):
+                await self.async_refresh()
+
+    @property
+    def params(self) -> Dict[str, Any]:
+        """Return the current parameter values."""
+        return self._params
+
     async def get_param_value(self, param: str) -> Any:
         """Get parameter value."""
         return self._params.get(param)
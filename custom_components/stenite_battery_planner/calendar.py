@@ -0,0 +1,146 @@
+"""Support for Stenite Battery Planner calendar entities."""
+from __future__ import annotations
+
+import logging
+from bisect import bisect_right
+from datetime import datetime
+from typing import Any, Dict, List
+
+from homeassistant.components.calendar import CalendarEntity, CalendarEvent
+from homeassistant.config_entries import ConfigEntry
+from homeassistant.core import HomeAssistant, callback
+from homeassistant.helpers.entity import DeviceInfo
+from homeassistant.helpers.entity_platform import AddEntitiesCallback
+from homeassistant.helpers.update_coordinator import CoordinatorEntity
+from homeassistant.util import dt as dt_util
+
+from . import DOMAIN, BatteryPlannerCoordinator
+from .models import PlanSchedule
+
+_LOGGER = logging.getLogger(__name__)
+
+# Schedule actions that are shown as calendar events
+EVENT_ACTIONS = {
+    "charge": "Charge",
+    "discharge": "Discharge",
+    "self_consumption": "Self Consumption",
+}
+
+
+async def async_setup_entry(
+    hass: HomeAssistant,
+    entry: ConfigEntry,
+    async_add_entities: AddEntitiesCallback,
+) -> None:
+    """Set up the Battery Planner calendar platform."""
+    coordinator = hass.data[DOMAIN][entry.entry_id]
+
+    async_add_entities([BatteryPlannerScheduleCalendar(coordinator, entry)])
+
+
+def merge_schedule(schedule: PlanSchedule) -> List[CalendarEvent]:
+    """Merge adjacent periods with the same action into calendar events."""
+    events: List[CalendarEvent] = []
+    current: Dict[str, Any] | None = None
+
+    def close() -> None:
+        hours = (current["end"] - current["start"]).total_seconds() / 3600
+        events.append(CalendarEvent(
+            start=current["start"],
+            end=current["end"],
+            summary=EVENT_ACTIONS[current["action"]],
+            description=(
+                f"{current['periods']} periods, average power "
+                f"{current['energy'] / hours if hours > 0 else 0.0:.3f}"
+            ),
+        ))
+
+    for start, end, action, power in zip(schedule.start, schedule.end, schedule.action, schedule.power):
+        energy = power * (end - start).total_seconds() / 3600
+
+        if current is not None and current["action"] == action and current["end"] == start:
+            current["end"] = end
+            current["energy"] += energy
+            current["periods"] += 1
+            continue
+
+        if current is not None:
+            close()
+        current = None
+        if action in EVENT_ACTIONS:
+            current = {"action": action, "start": start, "end": end, "energy": energy, "periods": 1}
+
+    if current is not None:
+        close()
+    events.sort(key=lambda event: event.start)
+    return events
+
+
+class BatteryPlannerScheduleCalendar(CoordinatorEntity, CalendarEntity):
+    """Calendar of the planned charge and discharge intervals."""
+
+    def __init__(
+        self,
+        coordinator: BatteryPlannerCoordinator,
+        entry: ConfigEntry,
+    ) -> None:
+        """Initialize the calendar."""
+        super().__init__(coordinator)
+        self._entry = entry
+
+        self._attr_has_entity_name = True
+        self._attr_unique_id = f"{entry.entry_id}_schedule_calendar"
+        self._attr_name = "Battery Schedule"
+
+        self._events: List[CalendarEvent] = []
+        # Event end times, sorted because the merged events never overlap
+        self._ends: List[datetime] = []
+        self._rebuild_index()
+
+    def _rebuild_index(self) -> None:
+        """Merge the current schedule into events and index them by end time."""
+        plan = self.coordinator.data
+        self._events = merge_schedule(plan.schedule) if plan else []
+        self._ends = [event.end for event in self._events]
+
+    @callback
+    def _handle_coordinator_update(self) -> None:
+        """Rebuild the event index when a new plan arrives."""
+        self._rebuild_index()
+        super()._handle_coordinator_update()
+
+    def _events_between(self, start: datetime, end: datetime) -> List[CalendarEvent]:
+        """Return the events overlapping the given window."""
+        events = []
+        for index in range(bisect_right(self._ends, start), len(self._events)):
+            event = self._events[index]
+            if event.start >= end:
+                break
+            events.append(event)
+        return events
+
+    @property
+    def event(self) -> CalendarEvent | None:
+        """Return the current or next upcoming event."""
+        index = bisect_right(self._ends, dt_util.now())
+        if index < len(self._events):
+            return self._events[index]
+        return None
+
+    async def async_get_events(
+        self,
+        hass: HomeAssistant,
+        start_date: datetime,
+        end_date: datetime,
+    ) -> list[CalendarEvent]:
+        """Return the events within a datetime range."""
+        return self._events_between(start_date, end_date)
+
+    @property
+    def device_info(self) -> DeviceInfo:
+        """Return device information."""
+        return DeviceInfo(
+            identifiers={(DOMAIN, self._entry.entry_id)},
+            name=self._entry.title,
+            manufacturer="Stenite",
+        )
@@ -1,33 +1,166 @@
 """Config flow for Stenite Battery Planner."""
 from __future__ import annotations
 
+import asyncio
 import logging
+import time
+from collections import OrderedDict
+import aiohttp
 import voluptuous as vol
-from typing import Any
+from typing import Any, Dict, Optional, Tuple
 
 from homeassistant import config_entries
 from homeassistant.const import CONF_NAME
 from homeassistant.data_entry_flow import FlowResult
-from homeassistant.core import callback
+from homeassistant.core import HomeAssistant, callback
 from homeassistant.helpers import selector
+from homeassistant.helpers.aiohttp_client import async_get_clientsession
 
 from . import (
     DOMAIN,
     DEFAULT_NAME,
+    DEFAULT_SCENARIO_COUNT,
+    PLANNER_API_ENDPOINT,
+    PLANNER_API_PARAM_ID,
+    PLANNER_LOCAL_PARAM_ID,
+    PLANNING_MODES,
     validate_positive_float,
     validate_positive_or_zero_float,
+    validate_curve,
+    validate_loads,
+    validate_tariff,
     validate_percentage,
 )
+from .models import PlanParseError, decode_plan
+from .planner import feasibility_problem
 
 _LOGGER = logging.getLogger(__name__)
 
 NORDPOOL_AREAS = ["SE1", "SE2", "SE3", "SE4"]
 
+DRY_RUN_TIMEOUT = 10
+DRY_RUN_CACHE_SIZE = 32
+DRY_RUN_CACHE_TTL = 600
+
+# Slot length assumed for the local checks when the API cannot be reached
+DRY_RUN_OFFLINE_HOURS = [1.0]
+
+# Dry-run outcomes keyed by the planner inputs, so resubmitting an unchanged
+# form does not query the API again
+_DRY_RUN_CACHE: OrderedDict[Tuple, Tuple[float, Optional[str], str]] = OrderedDict()
+
+
+async def async_dry_run(hass: HomeAssistant, user_input: Dict[str, Any]) -> Tuple[Optional[str], str]:
+    """Plan once with the given inputs and return an error key and a summary.
+
+    The error key is None when the inputs produce a feasible plan. An
+    unreachable API is not an error; the summary then says the settings
+    were only checked locally.
+    """
+    params = {
+        param: user_input[param]
+        for param in PLANNER_API_PARAM_ID + PLANNER_LOCAL_PARAM_ID
+        if param in user_input
+    }
+    key = tuple(sorted(params.items()))
+    cached = _DRY_RUN_CACHE.get(key)
+    if cached is not None and time.monotonic() - cached[0] < DRY_RUN_CACHE_TTL:
+        _DRY_RUN_CACHE.move_to_end(key)
+        return cached[1], cached[2]
+
+    error, summary, reached = await _async_dry_run_uncached(hass, params)
+    if reached:
+        # Connection problems are transient, everything else depends on the inputs
+        _DRY_RUN_CACHE[key] = (time.monotonic(), error, summary)
+        while len(_DRY_RUN_CACHE) > DRY_RUN_CACHE_SIZE:
+            _DRY_RUN_CACHE.popitem(last=False)
+    return error, summary
+
+
+async def _async_dry_run_uncached(
+        hass: HomeAssistant,
+        params: Dict[str, Any],
+) -> Tuple[Optional[str], str, bool]:
+    """Run the dry-run plan against the API and check the limits with the local engine.
+
+    Also returns whether the API was reached.
+    """
+    payload = {param: params[param] for param in PLANNER_API_PARAM_ID if param in params}
+    if float(payload.get("battery_capacity", 0)) <= 0:
+        return "capacity_zero", "Battery capacity must be greater than 0", True
+
+    plan = None
+    try:
+        session = async_get_clientsession(hass)
+        async with session.post(
+                PLANNER_API_ENDPOINT,
+                json=payload,
+                timeout=aiohttp.ClientTimeout(total=DRY_RUN_TIMEOUT),
+        ) as response:
+            if response.status != 200:
+                error_text = await response.text()
+                return "dry_run_failed", f"Planner returned status {response.status}: {error_text[:200]}", True
+            body = await response.read()
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        _LOGGER.warning(f"Could not reach the planner for the dry run: {e}")
+        body = None
+
+    if body is not None:
+        try:
+            plan = decode_plan(body)
+        except PlanParseError as e:
+            return "dry_run_failed", f"Planner returned a malformed plan: {e}", True
+        if not len(plan.schedule):
+            return "plan_infeasible", "The planner returned an empty schedule", True
+
+    if plan is not None:
+        hours = [(end - start).total_seconds() / 3600 for start, end, _ in plan.schedule.slots()]
+    else:
+        hours = DRY_RUN_OFFLINE_HOURS
+    problem = await hass.async_add_executor_job(feasibility_problem, params, hours)
+    if problem:
+        return "plan_infeasible", problem, plan is not None
+
+    if plan is None:
+        return None, "Warning: the planner could not be reached, so the settings were only checked locally", False
+    return None, f"Dry run planned {len(plan.schedule)} periods with expected savings {plan.savings:.2f}", True
+
+
+def _validate_dependent_values(user_input: Dict[str, Any]) -> Dict[str, str]:
+    """Validate interdependent values and return form errors."""
+    errors = {}
+    for curve in ("charge_efficiency_curve", "discharge_efficiency_curve", "soc_efficiency_curve"):
+        try:
+            validate_curve(user_input.get(curve, ""), curve)
+        except vol.Invalid:
+            errors[curve] = "invalid_curve"
+    try:
+        validate_tariff(user_input.get("tariff_rates", ""), "tariff_rates")
+    except vol.Invalid:
+        errors["tariff_rates"] = "invalid_tariff"
+    try:
+        validate_loads(user_input.get("flexible_loads", ""), "flexible_loads")
+    except vol.Invalid:
+        errors["flexible_loads"] = "invalid_loads"
+    if user_input.get("battery_min_soc", 0) > user_input.get("battery_max_soc", 100):
+        errors["battery_min_soc"] = "min_soc_exceeds_max"
+    if user_input.get("battery_min_discharge", 0) > user_input.get("battery_max_discharge", 1):
+        errors["battery_min_discharge"] = "min_discharge_exceeds_max"
+    if user_input.get("battery_min_charge", 0) > user_input.get("battery_max_charge", 1):
+        errors["battery_min_charge"] = "min_charge_exceeds_max"
+    return errors
+
+
 class SteniteBatteryPlannerConfigFlow(config_entries.ConfigFlow, domain=DOMAIN):
     """Handle a config flow for Stenite Battery Planner."""
 
     VERSION = 1
 
+    def __init__(self) -> None:
+        """Initialize the config flow."""
+        self._pending: Dict[str, Any] = {}
+        self._dry_run_result = ""
+
     @staticmethod
     @callback
     def async_get_options_flow(config_entry):
@@ -39,8 +172,11 @@ class SteniteBatteryPlannerConfigFlow(config_entries.ConfigFlow, domain=DOMAIN):
     ) -> FlowResult:
         """Handle the initial step."""
         errors = {}
+        dry_run_result = ""
 
         if user_input is not None:
+            # An optional entity that was left empty is not in the input
+            user_input.setdefault("grid_import_entity", "")
             try:
                 # Generate a unique ID based on the name
                 unique_id = f"{DOMAIN}_{user_input[CONF_NAME]}"
@@ -50,18 +186,18 @@ class SteniteBatteryPlannerConfigFlow(config_entries.ConfigFlow, domain=DOMAIN):
                 self._abort_if_unique_id_configured()
 
                 # Validate interdependent values
-                if user_input.get("battery_min_soc", 0) > user_input.get("battery_max_soc", 100):
-                    errors["battery_min_soc"] = "min_soc_exceeds_max"
-                if user_input.get("battery_min_discharge", 0) > user_input.get("battery_max_discharge", 1):
-                    errors["battery_min_discharge"] = "min_discharge_exceeds_max"
-                if user_input.get("battery_min_charge", 0) > user_input.get("battery_max_charge", 1):
-                    errors["battery_min_charge"] = "min_charge_exceeds_max"
+                errors = _validate_dependent_values(user_input)
 
+                # Plan once with the new values before accepting them
                 if not errors:
-                    return self.async_create_entry(
-                        title=user_input[CONF_NAME],
-                        data=user_input
-                    )
+                    error, dry_run_result = await async_dry_run(self.hass, user_input)
+                    if error:
+                        errors["base"] = error
+
+                if not errors:
+                    self._pending = user_input
+                    self._dry_run_result = dry_run_result
+                    return await self.async_step_confirm()
 
             except Exception as error:
                 _LOGGER.exception("Unexpected exception")
@@ -110,12 +246,51 @@ class SteniteBatteryPlannerConfigFlow(config_entries.ConfigFlow, domain=DOMAIN):
             vol.Required("stored_value_per_kWh", default=0.0): selector.NumberSelector(
                 selector.NumberSelectorConfig(min=0, max=100, step=0.01, mode="box")
             ),
+            vol.Required("auto_stored_value", default=False): selector.BooleanSelector(),
+            vol.Required("planning_mode", default="api"): selector.SelectSelector(
+                selector.SelectSelectorConfig(options=PLANNING_MODES)
+            ),
+            vol.Required("scenario_count", default=DEFAULT_SCENARIO_COUNT): selector.NumberSelector(
+                selector.NumberSelectorConfig(min=1, max=500, step=1, mode="box")
+            ),
+            vol.Optional("charge_efficiency_curve", default=""): selector.TextSelector(),
+            vol.Optional("discharge_efficiency_curve", default=""): selector.TextSelector(),
+            vol.Optional("soc_efficiency_curve", default=""): selector.TextSelector(),
+            vol.Required("dod_wear_exponent", default=1.0): selector.NumberSelector(
+                selector.NumberSelectorConfig(min=1, max=5, step=0.01, mode="box")
+            ),
+            vol.Optional("tariff_rates", default=""): selector.TextSelector(),
+            vol.Optional("flexible_loads", default=""): selector.TextSelector(),
+            vol.Required("peak_power_fee", default=0.0): selector.NumberSelector(
+                selector.NumberSelectorConfig(min=0, max=1000, step=0.01, mode="box")
+            ),
+            vol.Optional("grid_import_entity"): selector.EntitySelector(
+                selector.EntitySelectorConfig(domain="sensor", device_class="power")
+            ),
         }
 
         return self.async_show_form(
             step_id="user",
             data_schema=vol.Schema(data_schema),
             errors=errors,
+            description_placeholders={"dry_run_result": dry_run_result},
+        )
+
+
+    async def async_step_confirm(
+        self, user_input: dict[str, Any] | None = None
+    ) -> FlowResult:
+        """Show the dry-run result and create the entry once confirmed."""
+        if user_input is not None:
+            return self.async_create_entry(
+                title=self._pending[CONF_NAME],
+                data=self._pending
+            )
+
+        return self.async_show_form(
+            step_id="confirm",
+            data_schema=vol.Schema({}),
+            description_placeholders={"dry_run_result": self._dry_run_result},
         )
 
 
@@ -125,39 +300,31 @@ class OptionsFlowHandler(config_entries.OptionsFlow):
     def __init__(self, config_entry):
         """Initialize options flow."""
         self.config_entry = config_entry
+        self._pending: Dict[str, Any] = {}
+        self._dry_run_result = ""
 
     async def async_step_init(self, user_input=None):
         """Manage options."""
         errors = {}
+        dry_run_result = ""
 
         if user_input is not None:
+            # A cleared entity is not in the input, so it would keep its old value
+            user_input.setdefault("grid_import_entity", "")
             try:
                 # Validate interdependent values
-                if user_input.get("battery_min_soc", 0) > user_input.get("battery_max_soc", 100):
-                    errors["battery_min_soc"] = "min_soc_exceeds_max"
-                if user_input.get("battery_min_discharge", 0) > user_input.get("battery_max_discharge", 1):
-                    errors["battery_min_discharge"] = "min_discharge_exceeds_max"
-                if user_input.get("battery_min_charge", 0) > user_input.get("battery_max_charge", 1):
-                    errors["battery_min_charge"] = "min_charge_exceeds_max"
+                errors = _validate_dependent_values(user_input)
 
+                # Plan once with the new values before accepting them
                 if not errors:
-                    # Update the config entry data with the new values
-                    new_data = dict(self.config_entry.data)
-                    new_data.update(user_input)
-
-                    self.hass.config_entries.async_update_entry(
-                        self.config_entry,
-                        data=new_data,
-                    )
-
-                    # Update coordinator parameters if available
-                    coordinator = self.hass.data[DOMAIN].get(self.config_entry.entry_id)
-                    if coordinator:
-                        for key, value in user_input.items():
-                            await coordinator.set_param(key, value)
-                        await coordinator.async_refresh()
-
-                    return self.async_create_entry(title="", data=user_input)
+                    error, dry_run_result = await async_dry_run(self.hass, user_input)
+                    if error:
+                        errors["base"] = error
+
+                if not errors:
+                    self._pending = user_input
+                    self._dry_run_result = dry_run_result
+                    return await self.async_step_confirm()
             except Exception as error:
                 errors["base"] = "unknown"
 
@@ -177,6 +344,17 @@ class OptionsFlowHandler(config_entries.OptionsFlow):
             "battery_allow_export": self.config_entry.data.get("battery_allow_export", True),
             "network_charge_kWh": self.config_entry.data.get("network_charge_kWh", 0.3),
             "stored_value_per_kWh": self.config_entry.data.get("stored_value_per_kWh", 0),
+            "auto_stored_value": self.config_entry.data.get("auto_stored_value", False),
+            "planning_mode": self.config_entry.data.get("planning_mode", "api"),
+            "scenario_count": self.config_entry.data.get("scenario_count", DEFAULT_SCENARIO_COUNT),
+            "charge_efficiency_curve": self.config_entry.data.get("charge_efficiency_curve", ""),
+            "discharge_efficiency_curve": self.config_entry.data.get("discharge_efficiency_curve", ""),
+            "soc_efficiency_curve": self.config_entry.data.get("soc_efficiency_curve", ""),
+            "dod_wear_exponent": self.config_entry.data.get("dod_wear_exponent", 1.0),
+            "tariff_rates": self.config_entry.data.get("tariff_rates", ""),
+            "flexible_loads": self.config_entry.data.get("flexible_loads", ""),
+            "peak_power_fee": self.config_entry.data.get("peak_power_fee", 0.0),
+            "grid_import_entity": self.config_entry.data.get("grid_import_entity", ""),
         }
 
         # Define schema using selectors
@@ -220,10 +398,57 @@ class OptionsFlowHandler(config_entries.OptionsFlow):
             ),vol.Required("stored_value_per_kWh", default=current["stored_value_per_kWh"]): selector.NumberSelector(
                 selector.NumberSelectorConfig(min=0, max=100, step=0.001, mode="box")
             ),
+            vol.Required("auto_stored_value", default=current["auto_stored_value"]): selector.BooleanSelector(),
+            vol.Required("planning_mode", default=current["planning_mode"]): selector.SelectSelector(
+                selector.SelectSelectorConfig(options=PLANNING_MODES)
+            ),
+            vol.Required("scenario_count", default=current["scenario_count"]): selector.NumberSelector(
+                selector.NumberSelectorConfig(min=1, max=500, step=1, mode="box")
+            ),
+            vol.Optional("charge_efficiency_curve", default=current["charge_efficiency_curve"]): selector.TextSelector(),
+            vol.Optional("discharge_efficiency_curve", default=current["discharge_efficiency_curve"]): selector.TextSelector(),
+            vol.Optional("soc_efficiency_curve", default=current["soc_efficiency_curve"]): selector.TextSelector(),
+            vol.Required("dod_wear_exponent", default=current["dod_wear_exponent"]): selector.NumberSelector(
+                selector.NumberSelectorConfig(min=1, max=5, step=0.01, mode="box")
+            ),
+            vol.Optional("tariff_rates", default=current["tariff_rates"]): selector.TextSelector(),
+            vol.Optional("flexible_loads", default=current["flexible_loads"]): selector.TextSelector(),
+            vol.Required("peak_power_fee", default=current["peak_power_fee"]): selector.NumberSelector(
+                selector.NumberSelectorConfig(min=0, max=1000, step=0.01, mode="box")
+            ),
+            vol.Optional(
+                "grid_import_entity",
+                description={"suggested_value": current["grid_import_entity"]},
+            ): selector.EntitySelector(
+                selector.EntitySelectorConfig(domain="sensor", device_class="power")
+            ),
         }
 
         return self.async_show_form(
             step_id="init",
             data_schema=vol.Schema(data_schema),
             errors=errors,
-        )
\ No newline at end of file
+            description_placeholders={"dry_run_result": dry_run_result},
+        )
+
+    async def async_step_confirm(self, user_input=None):
+        """Show the dry-run result and apply the options once confirmed."""
+        if user_input is not None:
+            # Update the config entry data with the new values
+            new_data = dict(self.config_entry.data)
+            new_data.update(self._pending)
+
+            # The entry update listener applies the changed values to
+            # the running coordinator with a single replan
+            self.hass.config_entries.async_update_entry(
+                self.config_entry,
+                data=new_data,
+            )
+
+            return self.async_create_entry(title="", data=self._pending)
+
+        return self.async_show_form(
+            step_id="confirm",
+            data_schema=vol.Schema({}),
+            description_placeholders={"dry_run_result": self._dry_run_result},
+        )
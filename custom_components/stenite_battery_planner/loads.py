@@ -0,0 +1,272 @@
+"""Flexible loads co-scheduled with the battery by the local planning engine."""
+from __future__ import annotations
+
+import re
+from datetime import datetime, timedelta, tzinfo
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+from .planner import grid_energy, solve, trajectory
+
+# Battery and load schedules are re-planned against each other this many times
+LOAD_ITERATIONS = 3
+
+_NAME = re.compile(r"^[a-z][a-z0-9_]*$")
+_ENTITY_ID = re.compile(r"^[a-z_]+\.[a-z0-9_]+$")
+
+# Units a load's measuring sensor can report in -> (kind, factor to kWh or kW)
+MEASURED_UNITS = {
+    "W": ("power", 0.001),
+    "kW": ("power", 1.0),
+    "Wh": ("energy", 0.001),
+    "kWh": ("energy", 1.0),
+}
+
+# (name, energy kWh, min power kW, max power kW, deadline (hour, minute), entity id or "")
+LoadDefinition = Tuple[str, float, float, float, Tuple[int, int], str]
+
+# ("energy" or "power", kWh or kW)
+LoadReading = Tuple[str, float]
+
+# (name, energy still needed kWh, min power kW, max power kW, deadline)
+LoadRequest = Tuple[str, float, float, float, datetime]
+
+
+def parse_loads(text: Any) -> Tuple[LoadDefinition, ...]:
+    """Parse a ``name energy min-max HH:MM [entity], ...`` list of flexible loads.
+
+    For example ``ev 20 1.4-7.4 07:00, water_heater 5 0-3 18:00`` asks for
+    20 kWh in the EV by 07:00 at 1.4 to 7.4 kW and 5 kWh in the water heater
+    by 18:00 at up to 3 kW, every day. An optional trailing entity id, as in
+    ``ev 20 1.4-7.4 07:00 sensor.ev_charger_power``, names a power or energy
+    sensor measuring what the load actually draws. An empty value means no
+    loads. Raises ValueError on malformed definitions.
+    """
+    if not text:
+        return ()
+    loads = []
+    names = set()
+    for definition in str(text).split(","):
+        definition = definition.strip().lower()
+        if not definition:
+            continue
+        try:
+            name, energy, power, deadline, *entity = definition.split()
+            entity_id = entity.pop() if entity else ""
+            if entity:
+                raise ValueError(definition)
+            min_power, max_power = (float(value) for value in power.split("-"))
+            hour, minute = (int(value) for value in deadline.split(":"))
+            parsed = (name, float(energy), min_power, max_power, (hour, minute), entity_id)
+        except ValueError as err:
+            raise ValueError(f"Invalid flexible load: {definition}") from err
+        if not _NAME.match(name) or name in names:
+            raise ValueError(f"Invalid or repeated load name: {name}")
+        if parsed[1] < 0 or not 0 <= min_power <= max_power or max_power <= 0:
+            raise ValueError(f"Invalid load energy or power: {definition}")
+        if not (0 <= hour < 24 and 0 <= minute < 60):
+            raise ValueError(f"Invalid load deadline: {definition}")
+        if entity_id and not _ENTITY_ID.match(entity_id):
+            raise ValueError(f"Invalid load sensor: {definition}")
+        names.add(name)
+        loads.append(parsed)
+    return tuple(loads)
+
+
+def next_deadline(deadline: Tuple[int, int], now: datetime, time_zone: tzinfo) -> datetime:
+    """Return the first occurrence of a local time of day after now."""
+    local = now.astimezone(time_zone)
+    candidate = local.replace(hour=deadline[0], minute=deadline[1], second=0, microsecond=0)
+    if candidate <= local:
+        candidate += timedelta(days=1)
+    return candidate
+
+
+class LoadProgress:
+    """Energy delivered to every flexible load since its last deadline.
+
+    Loads with a sensor count what it measures between refreshes: the
+    increase of an energy meter, or the mean of two power readings over the
+    time between them. Nothing is counted while a power sensor is
+    unavailable; an energy meter's increase is counted once it is back.
+    Loads without one count the load power of the current plan, which
+    assumes the load ran as planned. Either way a load that has been running
+    since the morning only asks for what is still missing. Each load starts
+    over after its deadline.
+    """
+
+    def __init__(self) -> None:
+        """Initialize."""
+        # name -> [deadline, delivered kWh, time of last update, planned kW, last reading]
+        self._state: Dict[str, List[Any]] = {}
+
+    def requests(
+            self,
+            loads: Sequence[LoadDefinition],
+            now: datetime,
+            time_zone: tzinfo,
+            readings: Optional[Dict[str, LoadReading]] = None,
+    ) -> List[LoadRequest]:
+        """Account for the energy delivered up to now and return what is still needed.
+
+        ``readings`` holds the current sensor reading of the loads that have one.
+        """
+        readings = readings or {}
+        requests = []
+        for name, energy, min_power, max_power, deadline, entity_id in loads:
+            state = self._state.get(name)
+            reading = readings.get(name)
+            if state is not None:
+                state[1] += self._delivered_since(state, bool(entity_id), reading, now)
+                state[2] = now
+            if state is None or now >= state[0]:
+                state = self._state[name] = [next_deadline(deadline, now, time_zone), 0.0, now, 0.0, None]
+            # An energy meter's last value still holds while it is unavailable
+            if reading is not None or state[4] is None or state[4][0] != "energy":
+                state[4] = reading
+            requests.append((name, max(energy - state[1], 0.0), min_power, max_power, state[0]))
+
+        for name in set(self._state) - {load[0] for load in loads}:
+            del self._state[name]
+        return requests
+
+    @staticmethod
+    def _delivered_since(state: List[Any], measured: bool, reading: Optional[LoadReading], now: datetime) -> float:
+        """Return the energy delivered to a load since its last update."""
+        hours = max((min(now, state[0]) - state[2]).total_seconds(), 0.0) / 3600
+        if not measured:
+            return state[3] * hours
+        previous = state[4]
+        if reading is None or previous is None or previous[0] != reading[0]:
+            return 0.0
+        if reading[0] == "energy":
+            # A meter that went back was reset; count from the new value on
+            return max(reading[1] - previous[1], 0.0)
+        return max((previous[1] + reading[1]) / 2, 0.0) * hours
+
+    def set_power(self, name: str, power: float) -> None:
+        """Record the power a load is planned to run at from now on."""
+        if name in self._state:
+            self._state[name][3] = power
+
+    def delivered(self, name: str) -> float:
+        """Return the energy delivered to a load in its current cycle."""
+        return self._state[name][1] if name in self._state else 0.0
+
+
+def deferrable_energy(request: LoadRequest, horizon_end: datetime) -> float:
+    """Return the energy a load can still get after the planned horizon ends.
+
+    That part waits until the prices up to the load's deadline are published.
+    """
+    _, _, _, max_power, deadline = request
+    return max_power * max((deadline - horizon_end).total_seconds(), 0.0) / 3600
+
+
+def _slot_cost(price: float, rate: float, hours: float, net: float, peak_fee: float, peak: float) -> float:
+    """Return the grid cost of a slot's net energy, matching the battery tables."""
+    imported = max(net, 0.0)
+    cost = price * net + rate * imported
+    if peak_fee > 0 and hours > 0:
+        cost += peak_fee * max(imported / hours - peak, 0.0)
+    return cost
+
+
+def place_load(
+        params: Dict[str, Any],
+        slots: Sequence[Tuple[datetime, datetime, float]],
+        rates: Sequence[float],
+        request: LoadRequest,
+        base: Sequence[float],
+) -> List[float]:
+    """Schedule one load into the cheapest slots before its deadline.
+
+    ``base`` is the net grid energy per slot without this load. Slots are
+    ranked by the cost per kWh of running the load at full power on top of
+    it, so slots where the battery would otherwise export rank accordingly.
+    The peak power fee counts for the import above both the month's peak
+    and the highest import already planned in the horizon, as it is charged
+    once on the maximum. Only the energy that cannot be delivered after
+    the last slot is placed. Returns the load power per slot in kW.
+    """
+    _, energy, min_power, max_power, deadline = request
+    power = [0.0] * len(slots)
+    if slots:
+        energy -= deferrable_energy(request, slots[-1][1])
+    if energy <= 0:
+        return power
+
+    peak_fee = float(params.get("peak_power_fee") or 0.0)
+    peak = float(params.get("monthly_peak") or 0.0)
+    for (start, end, _), net in zip(slots, base):
+        hours = (end - start).total_seconds() / 3600
+        if hours > 0:
+            peak = max(peak, net / hours)
+
+    candidates = []
+    for t, (start, end, price) in enumerate(slots):
+        if end > deadline:
+            break
+        hours = (end - start).total_seconds() / 3600
+        if hours <= 0:
+            continue
+        added = max_power * hours
+        before = _slot_cost(price, rates[t], hours, base[t], peak_fee, peak)
+        after = _slot_cost(price, rates[t], hours, base[t] + added, peak_fee, peak)
+        candidates.append(((after - before) / added, t, hours))
+    candidates.sort()
+
+    remaining = energy
+    for _, t, hours in candidates:
+        if remaining <= 1e-9:
+            break
+        # Never run below the minimum power, even if it delivers a bit more
+        power[t] = max(min(max_power, remaining / hours), min_power)
+        remaining -= power[t] * hours
+    return power
+
+
+def co_optimize(
+        params: Dict[str, Any],
+        slots: Sequence[Tuple[datetime, datetime, float]],
+        requests: Sequence[LoadRequest],
+        rates: Sequence[float],
+        terminal: Sequence[float] | None = None,
+) -> Dict[str, Any]:
+    """Plan the battery and flexible loads together.
+
+    The loads are placed against the battery plan, the battery is solved
+    again with the loads as extra draw, and so on for up to
+    ``LOAD_ITERATIONS`` rounds or until the load schedules settle. The round
+    with the lowest total cost is kept. Every round is one battery pass plus
+    a sort per load, so a few loads only multiply the planning time by the
+    number of rounds. The result has the load power per slot under ``loads``.
+    """
+    hours = [(end - start).total_seconds() / 3600 for start, end, _ in slots]
+    loads = {request[0]: [0.0] * len(slots) for request in requests}
+    result = solve(params, slots, terminal, rates)
+    best = None
+
+    for _ in range(LOAD_ITERATIONS):
+        grid = grid_energy(params, slots, result)
+        changed = False
+        for request in requests:
+            own = loads[request[0]]
+            base = [energy - power * length for energy, power, length in zip(grid, own, hours)]
+            placed = place_load(params, slots, rates, request, base)
+            grid = [energy + power * length for energy, power, length in zip(base, placed, hours)]
+            changed = changed or placed != own
+            loads[request[0]] = placed
+        if not changed:
+            break
+
+        extra = [sum(power) for power in zip(*loads.values())]
+        result = solve(params, slots, terminal, rates, extra)
+        cost = result["value"][0][trajectory(result, params)[0]]
+        if best is None or cost < best[0]:
+            best = (cost, result, {name: list(power) for name, power in loads.items()})
+
+    if best is None:
+        result["loads"] = loads
+        return result
+    best[1]["loads"] = best[2]
+    return best[1]
@@ -0,0 +1,178 @@
+"""Typed plan model for Stenite Battery Planner API responses."""
+from __future__ import annotations
+
+import math
+from array import array
+from datetime import datetime
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+from homeassistant.util import dt as dt_util
+from homeassistant.util.json import json_loads
+
+
+class PlanParseError(ValueError):
+    """Raised when a plan response does not have the expected shape."""
+
+
+def _parse_time(value: Any, field: str) -> datetime:
+    """Parse a timestamp into an aware datetime."""
+    parsed = dt_util.parse_datetime(value) if isinstance(value, str) else None
+    if parsed is None:
+        raise PlanParseError(f"{field} is not a timestamp: {value!r}")
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=dt_util.DEFAULT_TIME_ZONE)
+    return parsed
+
+
+def _parse_number(value: Any, field: str) -> float:
+    """Coerce a numeric field to a finite float."""
+    if isinstance(value, bool):
+        raise PlanParseError(f"{field} is not a number: {value!r}")
+    try:
+        number = float(value)
+    except (TypeError, ValueError) as err:
+        raise PlanParseError(f"{field} is not a number: {value!r}") from err
+    if not math.isfinite(number):
+        raise PlanParseError(f"{field} is not finite: {value!r}")
+    return number
+
+
+class PlanSchedule:
+    """Plan periods stored as parallel columns."""
+
+    __slots__ = ("start", "end", "action", "power", "price", "savings", "_periods")
+
+    def __init__(
+            self,
+            start: Sequence[datetime],
+            end: Sequence[datetime],
+            action: Sequence[str],
+            power: Sequence[float],
+            price: Sequence[float],
+            savings: Sequence[float],
+    ) -> None:
+        """Initialize."""
+        self.start: Tuple[datetime, ...] = tuple(start)
+        self.end: Tuple[datetime, ...] = tuple(end)
+        self.action: Tuple[str, ...] = tuple(action)
+        self.power = array("d", power)
+        self.price = array("d", price)
+        self.savings = array("d", savings)
+        self._periods: Optional[List[Dict[str, Any]]] = None
+
+    @classmethod
+    def parse(cls, raw: Any) -> PlanSchedule:
+        """Parse and validate the schedule list of an API response."""
+        if not isinstance(raw, list):
+            raise PlanParseError("schedule is not a list")
+
+        start, end, action, power, price, savings = [], [], [], [], [], []
+        for index, period in enumerate(raw):
+            if not isinstance(period, dict):
+                raise PlanParseError(f"schedule[{index}] is not an object")
+            period_start = _parse_time(period.get("start_time"), f"schedule[{index}].start_time")
+            period_end = _parse_time(period.get("end_time"), f"schedule[{index}].end_time")
+            if period_end <= period_start:
+                raise PlanParseError(f"schedule[{index}] ends before it starts")
+            if not isinstance(period.get("action"), str):
+                raise PlanParseError(f"schedule[{index}].action is not a string")
+
+            start.append(period_start)
+            end.append(period_end)
+            action.append(period["action"])
+            power.append(_parse_number(period.get("power"), f"schedule[{index}].power"))
+            price.append(_parse_number(period.get("price"), f"schedule[{index}].price"))
+            savings.append(_parse_number(period.get("savings", 0.0), f"schedule[{index}].savings"))
+
+        return cls(start, end, action, power, price, savings)
+
+    def __len__(self) -> int:
+        """Return the number of periods."""
+        return len(self.start)
+
+    def slots(self) -> List[Tuple[datetime, datetime, float]]:
+        """Return (start, end, price) tuples for the local planning engine."""
+        return list(zip(self.start, self.end, self.price))
+
+    def periods(self) -> List[Dict[str, Any]]:
+        """Return the periods as API shaped dicts, built once per schedule."""
+        if self._periods is None:
+            self._periods = [
+                {
+                    "start_time": start.isoformat(),
+                    "end_time": end.isoformat(),
+                    "action": action,
+                    "power": power,
+                    "price": price,
+                    "savings": savings,
+                }
+                for start, end, action, power, price, savings in zip(
+                    self.start, self.end, self.action, self.power, self.price, self.savings
+                )
+            ]
+        return self._periods
+
+
+class Plan:
+    """A validated battery plan."""
+
+    __slots__ = ("action_type", "watts", "total_cost", "baseline_cost", "savings", "schedule", "extra")
+
+    def __init__(
+            self,
+            action_type: str,
+            watts: float,
+            total_cost: float,
+            baseline_cost: float,
+            schedule: PlanSchedule,
+            extra: Optional[Dict[str, Any]] = None,
+    ) -> None:
+        """Initialize."""
+        self.action_type = action_type
+        self.watts = watts
+        self.total_cost = total_cost
+        self.baseline_cost = baseline_cost
+        self.savings = baseline_cost - total_cost
+        self.schedule = schedule
+        # Response fields the model does not know about, passed through as is
+        self.extra = extra or {}
+
+    def as_dict(self) -> Dict[str, Any]:
+        """Return the plan in the API response format."""
+        return {
+            **self.extra,
+            "action_type": self.action_type,
+            "watts": self.watts,
+            "total_cost": self.total_cost,
+            "baseline_cost": self.baseline_cost,
+            "schedule": self.schedule.periods(),
+        }
+
+
+PLAN_FIELDS = ("action_type", "watts", "total_cost", "baseline_cost", "schedule")
+
+
+def parse_plan(raw: Any) -> Plan:
+    """Validate a decoded API response and build a plan from it."""
+    if not isinstance(raw, dict):
+        raise PlanParseError("plan is not an object")
+    if not isinstance(raw.get("action_type"), str):
+        raise PlanParseError("action_type is not a string")
+
+    return Plan(
+        action_type=raw["action_type"],
+        watts=_parse_number(raw.get("watts"), "watts"),
+        total_cost=_parse_number(raw.get("total_cost"), "total_cost"),
+        baseline_cost=_parse_number(raw.get("baseline_cost"), "baseline_cost"),
+        schedule=PlanSchedule.parse(raw.get("schedule")),
+        extra={key: value for key, value in raw.items() if key not in PLAN_FIELDS},
+    )
+
+
+def decode_plan(body: bytes) -> Plan:
+    """Decode a plan response body."""
+    try:
+        raw = json_loads(body)
+    except ValueError as err:
+        raise PlanParseError(f"response is not valid JSON: {err}") from err
+    return parse_plan(raw)
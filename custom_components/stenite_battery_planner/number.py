@@ -70,7 +70,7 @@ class BatteryPlannerInputNumber(CoordinatorEntity, NumberEntity):
     @property
     def native_value(self) -> int | float | None:
         """Return the current value."""
-        return self._value
+        return self.coordinator.params.get(self._param_id, self._value)
 
     async def async_set_native_value(self, value: int | float):
         """Update the current value."""
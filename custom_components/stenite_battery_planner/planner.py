@@ -0,0 +1,562 @@
+"""Local planning engine for Stenite Battery Planner.
+
+The Stenite API returns the day-ahead price for every period of the plan. This
+module runs a dynamic programming pass over those prices with the same battery
+parameters so that derived values, such as the marginal value of stored
+energy, can be computed locally without another API round trip.
+"""
+from __future__ import annotations
+
+from datetime import datetime
+from functools import lru_cache
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+# Number of discrete state of charge levels between min and max SOC
+SOC_LEVELS = 41
+
+INFEASIBLE = float("inf")
+
+# Import power caps tried between the month's peak and the highest possible
+# import when a peak power fee applies
+PEAK_CANDIDATES = 6
+
+
+def soc_levels(params: Dict[str, Any]) -> List[float]:
+    """Return the discrete battery energy levels in kWh."""
+    capacity = float(params["battery_capacity"])
+    low = capacity * float(params["battery_min_soc"]) / 100
+    high = capacity * float(params["battery_max_soc"]) / 100
+    if capacity <= 0 or high <= low:
+        return [max(low, 0.0)]
+    step = (high - low) / (SOC_LEVELS - 1)
+    return [low + i * step for i in range(SOC_LEVELS)]
+
+
+def parse_curve(text: Any) -> Tuple[Tuple[float, float], ...]:
+    """Parse a ``x:y, x:y`` curve into sorted points.
+
+    An empty value means no curve. Raises ValueError on malformed points.
+    """
+    if not text:
+        return ()
+    points = []
+    for point in str(text).split(","):
+        if not point.strip():
+            continue
+        x, y = point.split(":")
+        points.append((float(x), float(y)))
+    points.sort()
+    return tuple(points)
+
+
+def _interpolate(points: Sequence[Tuple[float, float]], x: float, default: float) -> float:
+    """Linearly interpolate a curve, holding the end values outside its range."""
+    if not points:
+        return default
+    if x <= points[0][0]:
+        return points[0][1]
+    for (x0, y0), (x1, y1) in zip(points, points[1:]):
+        if x <= x1:
+            return y0 + (y1 - y0) * (x - x0) / (x1 - x0) if x1 > x0 else y1
+    return points[-1][1]
+
+
+def _allowed_moves(params: Dict[str, Any], step: float, hours: float) -> List[int]:
+    """Return the level offsets reachable within one slot of the given length."""
+    if step <= 0:
+        return [0]
+
+    moves = [0]
+    for sign, min_key, max_key in ((1, "battery_min_charge", "battery_max_charge"),
+                                   (-1, "battery_min_discharge", "battery_max_discharge")):
+        min_energy = float(params[min_key]) * hours
+        max_energy = float(params[max_key]) * hours
+        k = 1
+        while k * step <= max_energy + 1e-9:
+            if k * step >= min_energy - 1e-9:
+                moves.append(sign * k)
+            k += 1
+    return moves
+
+
+# Parameters the lookup tables depend on, in cache key order
+_TABLE_PARAMS = (
+    "battery_capacity",
+    "battery_min_soc",
+    "battery_max_soc",
+    "battery_min_charge",
+    "battery_max_charge",
+    "battery_min_discharge",
+    "battery_max_discharge",
+    "mean_draw",
+    "battery_cycle_cost",
+    "battery_allow_export",
+    "charge_efficiency_curve",
+    "discharge_efficiency_curve",
+    "soc_efficiency_curve",
+    "dod_wear_exponent",
+    "import_cap",
+)
+
+
+def _slot_tables(
+        params: Dict[str, Any],
+        hours: float,
+        extra: float = 0.0,
+) -> List[List[Tuple[int, float, float, float]]]:
+    """Return the lookup table of every feasible move per level for one slot.
+
+    ``extra`` is load power in kW drawn on top of ``mean_draw`` in the slot.
+    Tables are cached per parameter set, slot length and extra load, so the
+    efficiency and wear models are evaluated once and not inside the
+    backward pass.
+    """
+    key = tuple(params.get(param) for param in _TABLE_PARAMS) + (hours, round(extra, 3))
+    return _build_slot_tables(key)
+
+
+@lru_cache(maxsize=128)
+def _build_slot_tables(key: Tuple) -> List[List[Tuple[int, float, float, float]]]:
+    """Build the per level ``(offset, net grid energy, import, fixed cost)`` entries.
+
+    The cost of a move at price ``p`` and grid energy rate ``r`` is
+    ``p * net + r * import + fixed``. Charging draws
+    the stored energy divided by the charge efficiency from the grid and
+    discharging delivers the energy times the discharge efficiency, both
+    evaluated at the move's power and mid-point SOC. Wear follows a depth of
+    discharge model where a cycle to depth ``D`` costs ``cycle_cost * D ** n``,
+    which is the flat per kWh cycle cost for ``n = 1``. Moves that import
+    more than ``import_cap`` kW on average over the slot are left out.
+    """
+    params = dict(zip(_TABLE_PARAMS, key[:-2]))
+    hours, extra = key[-2:]
+    levels = soc_levels(params)
+    step = levels[1] - levels[0] if len(levels) > 1 else 0.0
+    moves = _allowed_moves(params, step, hours)
+
+    draw = (float(params["mean_draw"]) + extra) * hours
+    capacity = float(params["battery_capacity"])
+    cycle_cost = float(params["battery_cycle_cost"])
+    allow_export = bool(params["battery_allow_export"])
+    charge_curve = parse_curve(params["charge_efficiency_curve"])
+    discharge_curve = parse_curve(params["discharge_efficiency_curve"])
+    soc_curve = parse_curve(params["soc_efficiency_curve"])
+    exponent = float(params["dod_wear_exponent"] or 1.0)
+    import_cap = params["import_cap"]
+
+    tables = []
+    for i, level in enumerate(levels):
+        row = []
+        for k in moves:
+            j = i + k
+            if j < 0 or j >= len(levels):
+                continue
+            delta = k * step
+            power = abs(delta) / hours if hours > 0 else 0.0
+            mid = level + delta / 2
+            soc_factor = _interpolate(soc_curve, mid / capacity * 100, 1.0) if capacity > 0 else 1.0
+
+            # Efficiencies above 1 would let the battery create energy
+            if delta > 0:
+                efficiency = min(_interpolate(charge_curve, power, 1.0) * soc_factor, 1.0)
+                grid = delta / efficiency if efficiency > 0 else INFEASIBLE
+            else:
+                efficiency = min(_interpolate(discharge_curve, power, 1.0) * soc_factor, 1.0)
+                grid = delta * efficiency
+
+            net = draw + grid
+            if net == INFEASIBLE or (net < 0 and not allow_export):
+                continue
+
+            imported = max(net, 0.0)
+            if import_cap is not None and hours > 0 and imported / hours > import_cap + 1e-9:
+                continue
+            fixed = 0.0
+            if capacity > 0 and delta != 0:
+                # Half of the cycle cost is assigned to each direction
+                depth = min(max(1 - mid / capacity, 0.0), 1.0)
+                fixed += cycle_cost / (2 * capacity) * exponent * depth ** (exponent - 1) * abs(delta)
+            row.append((k, net, imported, fixed))
+        tables.append(row)
+    return tables
+
+
+def feasibility_problem(params: Dict[str, Any], hours: Sequence[float]) -> Optional[str]:
+    """Return why the battery limits leave no usable schedule, or None.
+
+    The battery has to be able to charge and to discharge in a slot of the
+    given lengths. Otherwise it can never leave its current SOC, or never
+    get back to it, no matter what the prices are.
+    """
+    levels = soc_levels(params)
+    if len(levels) < 2:
+        return "The capacity and SOC limits leave no usable energy"
+
+    can_charge = can_discharge = False
+    for length in set(hours):
+        for row in _slot_tables(params, length):
+            for k, _, _, _ in row:
+                can_charge = can_charge or k > 0
+                can_discharge = can_discharge or k < 0
+
+    step = levels[1] - levels[0]
+    if not can_charge:
+        return f"The charge power limits allow no charge step of {step:.3f} kWh within one period"
+    if not can_discharge:
+        if not params["battery_allow_export"]:
+            return "The minimum discharge power exceeds what the mean draw can absorb without export"
+        return f"The discharge power limits allow no discharge step of {step:.3f} kWh within one period"
+    return None
+
+
+def _backward_step(
+        tables: Sequence[Sequence[Tuple[int, float, float, float]]],
+        price: float,
+        rate: float,
+        following: Sequence[float],
+) -> Tuple[List[float], List[int]]:
+    """Return the cost-to-go and best move per level for one slot."""
+    count = len(following)
+    current = [INFEASIBLE] * count
+    chosen = [0] * count
+    for i in range(count):
+        best = INFEASIBLE
+        best_move = 0
+        for k, net, imported, fixed in tables[i]:
+            total = price * net + rate * imported + fixed + following[i + k]
+            if total < best:
+                best = total
+                best_move = k
+        current[i] = best
+        chosen[i] = best_move
+    return current, chosen
+
+
+def _slot_hours(slots: Sequence[Tuple[datetime, datetime, float]]) -> List[float]:
+    """Return the length of every slot in hours."""
+    return [(end - start).total_seconds() / 3600 for start, end, _ in slots]
+
+
+def terminal_values(params: Dict[str, Any], levels: Sequence[float]) -> List[float]:
+    """Return the cost-to-go at the end of the horizon, crediting stored energy."""
+    stored_value = float(params["stored_value_per_kWh"])
+    return [-stored_value * level for level in levels]
+
+
+def _rates(params: Dict[str, Any], count: int, rates: Optional[Sequence[float]]) -> Sequence[float]:
+    """Return the grid energy rate per slot, defaulting to the flat network charge."""
+    if rates is not None:
+        return rates
+    return [float(params["network_charge_kWh"])] * count
+
+
+def solve(
+        params: Dict[str, Any],
+        slots: Sequence[Tuple[datetime, datetime, float]],
+        terminal: Optional[Sequence[float]] = None,
+        rates: Optional[Sequence[float]] = None,
+        extra: Optional[Sequence[float]] = None,
+) -> Dict[str, Any]:
+    """Solve the battery schedule over the given price slots.
+
+    Returns the energy levels, the cost-to-go table ``value[t][i]`` for being
+    at level ``i`` at the start of slot ``t`` and the optimal level offset
+    ``policy[t][i]``. ``terminal`` is the cost-to-go per level after the last
+    slot and defaults to crediting ``stored_value_per_kWh`` per kWh left.
+    ``rates`` is the grid energy rate per slot and defaults to the flat
+    ``network_charge_kWh``. ``extra`` is additional load power in kW per
+    slot, such as scheduled flexible loads, and is kept in the result.
+
+    The peak power fee is charged once, on how far the highest planned
+    import of the horizon exceeds ``monthly_peak``. A maximum does not add
+    up slot by slot, so the horizon is solved with a few import caps
+    between the peak and the highest possible import and the cheapest plan
+    including its fee is kept. The fee is added to every cost-to-go.
+    """
+    rates = _rates(params, len(slots), rates)
+    extra = list(extra) if extra is not None else [0.0] * len(slots)
+    fee = float(params.get("peak_power_fee") or 0.0)
+    if fee <= 0 or not slots:
+        return _solve_capped(params, slots, terminal, rates, extra)
+
+    peak = float(params.get("monthly_peak") or 0.0)
+    hours = _slot_hours(slots)
+    highest = max(
+        imported / length
+        for length, load in set(zip(hours, extra)) if length > 0
+        for row in _slot_tables(params, length, load)
+        for _, _, imported, _ in row
+    ) if any(length > 0 for length in hours) else 0.0
+    if highest <= peak:
+        return _solve_capped(params, slots, terminal, rates, extra)
+
+    levels = soc_levels(params)
+    start = nearest_level(levels, float(params["battery_capacity"]) * float(params["battery_soc"]) / 100)
+    best = None
+    for step in range(PEAK_CANDIDATES + 1):
+        # The last candidate is uncapped
+        cap = peak + (highest - peak) * step / PEAK_CANDIDATES if step < PEAK_CANDIDATES else None
+        result = _solve_capped({**params, "import_cap": cap}, slots, terminal, rates, extra)
+        if result["value"][0][start] == INFEASIBLE:
+            continue
+        imports = grid_energy(params, slots, result)
+        planned = max(max(energy, 0.0) / length for energy, length in zip(imports, hours) if length > 0)
+        cost = fee * max(planned - peak, 0.0)
+        if best is None or result["value"][0][start] + cost < best[0]:
+            best = (result["value"][0][start] + cost, result, cost)
+
+    if best is None:
+        return _solve_capped(params, slots, terminal, rates, extra)
+    _, result, cost = best
+    result["value"] = [[value + cost for value in row] for row in result["value"]]
+    result["peak_cost"] = cost
+    return result
+
+
+def _solve_capped(
+        params: Dict[str, Any],
+        slots: Sequence[Tuple[datetime, datetime, float]],
+        terminal: Optional[Sequence[float]],
+        rates: Sequence[float],
+        extra: List[float],
+) -> Dict[str, Any]:
+    """Run the backward pass with the import cap in ``params``, if any."""
+    levels = soc_levels(params)
+
+    value: List[List[float]] = [[] for _ in range(len(slots) + 1)]
+    value[-1] = list(terminal) if terminal is not None else terminal_values(params, levels)
+    policy: List[List[int]] = [[] for _ in range(len(slots))]
+
+    for t, hours in reversed(list(enumerate(_slot_hours(slots)))):
+        tables = _slot_tables(params, hours, extra[t])
+        value[t], policy[t] = _backward_step(tables, slots[t][2], rates[t], value[t + 1])
+
+    return {"levels": levels, "value": value, "policy": policy, "extra": extra, "rates": list(rates)}
+
+
+def expected_terminal(
+        params: Dict[str, Any],
+        hours: Sequence[float],
+        scenarios: Sequence[Sequence[float]],
+        rates: Optional[Sequence[float]] = None,
+) -> List[float]:
+    """Return the expected cost-to-go per level over a set of price scenarios.
+
+    Every scenario is a price per slot over the same slot lengths. The move
+    lookup tables are shared by the whole batch, so each scenario only pays
+    for its own backward pass.
+    """
+    levels = soc_levels(params)
+    end = terminal_values(params, levels)
+    if not scenarios:
+        return end
+
+    per_slot = [_slot_tables(params, length) for length in hours]
+    rates = _rates(params, len(hours), rates)
+
+    expected = [0.0] * len(levels)
+    for prices in scenarios:
+        following = end
+        for t in range(len(hours) - 1, -1, -1):
+            following, _ = _backward_step(per_slot[t], prices[t], rates[t], following)
+        expected = [total + value for total, value in zip(expected, following)]
+
+    return [total / len(scenarios) for total in expected]
+
+
+def extend(
+        params: Dict[str, Any],
+        previous_slots: Sequence[Tuple[datetime, datetime, float]],
+        slots: Sequence[Tuple[datetime, datetime, float]],
+        terminal: Optional[Sequence[float]] = None,
+        rates: Optional[Sequence[float]] = None,
+) -> Dict[str, Any]:
+    """Extend a solved plan to a longer horizon.
+
+    Every decision, including the ones about to be dispatched, depends on
+    the newly published prices, so the backward pass runs over the whole
+    horizon. What is reused are the lookup tables, which are cached per
+    parameter set and slot length, so only the backward pass itself is
+    paid for. ``reused`` in the result is the number of slots that were
+    already planned.
+    """
+    result = solve(params, slots, terminal, rates)
+    planned = {start for start, _, _ in previous_slots}
+    result["reused"] = sum(1 for start, _, _ in slots if start in planned)
+    return result
+
+
+def grid_energy(
+        params: Dict[str, Any],
+        slots: Sequence[Tuple[datetime, datetime, float]],
+        result: Dict[str, Any],
+) -> List[float]:
+    """Return the planned net grid energy in kWh per slot, loads included."""
+    path = trajectory(result, params)
+    extra = result.get("extra") or [0.0] * len(slots)
+
+    energy = []
+    for t, hours in enumerate(_slot_hours(slots)):
+        i, j = path[t], path[t + 1]
+        row = _slot_tables(params, hours, extra[t])[i]
+        energy.append(next((net for k, net, _, _ in row if i + k == j), 0.0))
+    return energy
+
+
+def nearest_level(levels: Sequence[float], energy: float) -> int:
+    """Return the index of the level closest to the given energy."""
+    if len(levels) < 2:
+        return 0
+    step = levels[1] - levels[0]
+    index = round((energy - levels[0]) / step)
+    return min(max(index, 0), len(levels) - 1)
+
+
+def trajectory(result: Dict[str, Any], params: Dict[str, Any]) -> List[int]:
+    """Follow the optimal policy from the current SOC and return the level per slot."""
+    levels = result["levels"]
+    energy = float(params["battery_capacity"]) * float(params["battery_soc"]) / 100
+    index = nearest_level(levels, energy)
+
+    path = [index]
+    for chosen in result["policy"]:
+        index += chosen[index]
+        path.append(index)
+    return path
+
+
+def marginal_values(result: Dict[str, Any], path: Sequence[int]) -> List[float]:
+    """Return the marginal value of stored energy at the start of each slot.
+
+    This is the negative slope of the cost-to-go with respect to stored energy
+    along the planned trajectory, i.e. what one more kWh in the battery is worth.
+    """
+    levels = result["levels"]
+    value = result["value"]
+    count = len(levels)
+    if count < 2:
+        return [0.0] * len(result["policy"])
+    step = levels[1] - levels[0]
+
+    prices = []
+    for t in range(len(result["policy"])):
+        row = value[t]
+        i = path[t]
+        low = i - 1
+        high = i + 1
+        # Skip over neighbours that cannot reach the end of the horizon
+        while low >= 0 and row[low] == INFEASIBLE:
+            low -= 1
+        while high < count and row[high] == INFEASIBLE:
+            high += 1
+        low = max(low, 0)
+        high = min(high, count - 1)
+        if high == low or row[high] == INFEASIBLE or row[low] == INFEASIBLE:
+            prices.append(0.0)
+            continue
+        prices.append(-(row[high] - row[low]) / ((high - low) * step))
+    return prices
+
+
+def shadow_prices(
+        params: Dict[str, Any],
+        slots: Sequence[Tuple[datetime, datetime, float]],
+        result: Optional[Dict[str, Any]] = None,
+) -> List[Dict[str, Any]]:
+    """Return the per-slot marginal value of stored energy for the given prices."""
+    if not slots:
+        return []
+    if result is None:
+        result = solve(params, slots)
+    path = trajectory(result, params)
+    values = marginal_values(result, path)
+    levels = result["levels"]
+    capacity = float(params["battery_capacity"])
+
+    forecast = []
+    for (start, end, _), value, index in zip(slots, values, path):
+        forecast.append({
+            "start_time": start.isoformat(),
+            "end_time": end.isoformat(),
+            "value": round(value, 4),
+            "soc": round(levels[index] / capacity * 100, 2) if capacity > 0 else 0.0,
+        })
+    return forecast
+
+
+def plan_costs(
+        params: Dict[str, Any],
+        slots: Sequence[Tuple[datetime, datetime, float]],
+        result: Dict[str, Any],
+) -> Tuple[float, float]:
+    """Return the grid and wear cost of a solved plan and of leaving the battery idle.
+
+    Both cover the published slots only, without crediting energy left at
+    the end, and include the peak power fee.
+    """
+    path = trajectory(result, params)
+    extra = result.get("extra") or [0.0] * len(slots)
+    rates = result.get("rates") or _rates(params, len(slots), None)
+    draw = float(params["mean_draw"])
+    fee = float(params.get("peak_power_fee") or 0.0)
+    peak = float(params.get("monthly_peak") or 0.0)
+
+    total = float(result.get("peak_cost", 0.0))
+    baseline = 0.0
+    idle_peak = peak
+    for t, ((_, _, price), hours) in enumerate(zip(slots, _slot_hours(slots))):
+        i, j = path[t], path[t + 1]
+        row = _slot_tables(params, hours, extra[t])[i]
+        for k, net, imported, fixed in row:
+            if i + k == j:
+                total += price * net + rates[t] * imported + fixed
+                break
+        idle = (draw + extra[t]) * hours
+        baseline += price * idle + rates[t] * max(idle, 0.0)
+        if hours > 0:
+            idle_peak = max(idle_peak, idle / hours)
+    baseline += fee * (idle_peak - peak)
+    return total, baseline
+
+
+def schedule(
+        params: Dict[str, Any],
+        slots: Sequence[Tuple[datetime, datetime, float]],
+        result: Dict[str, Any],
+) -> Dict[str, Any]:
+    """Turn a solved plan into API shaped schedule periods and totals."""
+    levels = result["levels"]
+    path = trajectory(result, params)
+    draw = float(params["mean_draw"])
+    extra = result.get("extra") or [0.0] * len(slots)
+    allow_export = bool(params["battery_allow_export"])
+
+    periods = []
+    for (start, end, price), hours, before, after, load in zip(
+            slots, _slot_hours(slots), path, path[1:], extra
+    ):
+        power = (levels[after] - levels[before]) / hours if hours > 0 else 0.0
+        if power > 1e-9:
+            action = "charge"
+        elif power < -1e-9:
+            action = "discharge" if allow_export and -power > draw + load else "self_consumption"
+        else:
+            action = "idle"
+        periods.append({
+            "start_time": start.isoformat(),
+            "end_time": end.isoformat(),
+            "action": action,
+            "power": round(abs(power), 3),
+            "price": price,
+        })
+
+    current = periods[0] if periods else {"action": "idle", "power": 0.0}
+    total_cost, baseline_cost = plan_costs(params, slots, result)
+    return {
+        "action_type": current["action"],
+        "watts": round(current["power"] * 1000),
+        "total_cost": round(total_cost, 4),
+        "baseline_cost": round(baseline_cost, 4),
+        "expected_cost": round(result["value"][0][path[0]], 4) if periods else 0.0,
+        "schedule": periods,
+    }
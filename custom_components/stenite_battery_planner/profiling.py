@@ -0,0 +1,107 @@
+"""Opt-in profiling hooks for the Stenite Battery Planner refresh pipeline."""
+from __future__ import annotations
+
+import cProfile
+import pstats
+from contextlib import contextmanager
+from time import perf_counter
+from typing import Any, Dict, Iterator, List, Optional
+
+
+class RefreshProfiler:
+    """Collect timed spans and counters around the coordinator refresh pipeline.
+
+    Spans are only recorded while profiling is enabled, so the hooks cost a
+    single attribute check when it is switched off.
+    """
+
+    def __init__(self) -> None:
+        """Initialize."""
+        self.enabled = False
+        self._spans: Dict[str, Dict[str, float]] = {}
+        self._counters: Dict[str, int] = {}
+        self._capture: Optional[List[Dict[str, Any]]] = None
+
+    @contextmanager
+    def span(self, name: str) -> Iterator[None]:
+        """Time the wrapped block and record it under the given span name."""
+        if not self.enabled:
+            yield
+            return
+
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, perf_counter() - start)
+
+    def record(self, name: str, elapsed: float) -> None:
+        """Record a span duration in seconds."""
+        span = self._spans.get(name)
+        if span is None:
+            span = self._spans[name] = {"count": 0, "total": 0.0, "max": 0.0}
+        span["count"] += 1
+        span["total"] += elapsed
+        if elapsed > span["max"]:
+            span["max"] = elapsed
+
+    def count(self, name: str, amount: int = 1) -> None:
+        """Increase a counter while profiling is enabled."""
+        if self.enabled:
+            self._counters[name] = self._counters.get(name, 0) + amount
+
+    def reset(self) -> None:
+        """Drop all collected spans, counters and the last capture."""
+        self._spans.clear()
+        self._counters.clear()
+        self._capture = None
+
+    @contextmanager
+    def capture(self, top: int = 20) -> Iterator[None]:
+        """Run the wrapped block under cProfile and keep the top entries.
+
+        The profiler is enabled on the event loop thread, so any other work the
+        loop runs while the block is suspended shows up in the capture as well.
+        """
+        profile = cProfile.Profile()
+        profile.enable()
+        try:
+            yield
+        finally:
+            profile.disable()
+            self._capture = self._summarize_capture(profile, top)
+
+    @staticmethod
+    def _summarize_capture(profile: cProfile.Profile, top: int) -> List[Dict[str, Any]]:
+        """Convert cProfile stats into a list sorted by cumulative time."""
+        stats = pstats.Stats(profile)
+        rows = []
+        for (filename, line, function), (_, calls, total, cumulative, _) in stats.stats.items():
+            rows.append({
+                "function": f"{filename}:{line}({function})",
+                "calls": calls,
+                "total_ms": round(total * 1000, 3),
+                "cumulative_ms": round(cumulative * 1000, 3),
+            })
+        rows.sort(key=lambda row: row["cumulative_ms"], reverse=True)
+        return rows[:top]
+
+    def summary(self) -> Dict[str, Any]:
+        """Return the collected results in a service response friendly format."""
+        spans = {}
+        for name, span in self._spans.items():
+            spans[name] = {
+                "count": int(span["count"]),
+                "total_ms": round(span["total"] * 1000, 3),
+                "mean_ms": round(span["total"] * 1000 / span["count"], 3),
+                "max_ms": round(span["max"] * 1000, 3),
+            }
+
+        result: Dict[str, Any] = {
+            "enabled": self.enabled,
+            "spans": spans,
+            "counters": dict(self._counters),
+        }
+        if self._capture is not None:
+            result["capture"] = self._capture
+        return result
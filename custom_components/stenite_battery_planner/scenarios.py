@@ -0,0 +1,127 @@
+"""Price scenarios for the unpublished part of the planning horizon."""
+from __future__ import annotations
+
+import math
+import random
+from datetime import datetime, timedelta
+from typing import Any, Dict, List, Sequence, Tuple
+
+# Correlation between the price deviations of consecutive hours
+SCENARIO_CORRELATION = 0.8
+
+# Hourly statistics need this many samples before they replace the fallback
+MIN_SAMPLES = 3
+
+
+class PriceStatistics:
+    """Running per-area, per-hour-of-day price mean and variance.
+
+    Statistics are built from the prices returned in every plan, so they
+    follow the areas and price levels the installation actually sees.
+    """
+
+    def __init__(self, data: Dict[str, Any] | None = None) -> None:
+        """Initialize from previously stored data."""
+        data = data or {}
+        self._hours: Dict[str, List[List[float]]] = data.get("hours", {})
+        self._last_recorded: Dict[str, str] = data.get("last_recorded", {})
+
+    def as_dict(self) -> Dict[str, Any]:
+        """Return the statistics in a storable format."""
+        return {"hours": self._hours, "last_recorded": self._last_recorded}
+
+    def record(self, area: str, slots: Sequence[Tuple[datetime, datetime, float]]) -> bool:
+        """Add the prices of slots not seen before, returning whether any were new."""
+        hours = self._hours.get(area)
+        if hours is None:
+            # count, mean and sum of squared deviations per hour of day
+            hours = self._hours[area] = [[0, 0.0, 0.0] for _ in range(24)]
+        last = self._last_recorded.get(area)
+        last_start = datetime.fromisoformat(last) if last else None
+
+        added = False
+        for start, _, price in slots:
+            if last_start is not None and start <= last_start:
+                continue
+            stats = hours[start.hour]
+            stats[0] += 1
+            delta = price - stats[1]
+            stats[1] += delta / stats[0]
+            stats[2] += delta * (price - stats[1])
+            last_start = start
+            added = True
+
+        if added:
+            self._last_recorded[area] = last_start.isoformat()
+        return added
+
+    def hourly(self, area: str, fallback: Sequence[float]) -> Tuple[List[float], List[float]]:
+        """Return the mean and standard deviation of the price per hour of day.
+
+        Hours without enough samples use the mean and spread of ``fallback``.
+        """
+        mean = sum(fallback) / len(fallback) if fallback else 0.0
+        spread = math.sqrt(sum((p - mean) ** 2 for p in fallback) / len(fallback)) if fallback else 0.0
+
+        means = [mean] * 24
+        deviations = [spread] * 24
+        for hour, (count, hour_mean, squares) in enumerate(self._hours.get(area, [])):
+            if count >= MIN_SAMPLES:
+                means[hour] = hour_mean
+                deviations[hour] = math.sqrt(squares / (count - 1))
+        return means, deviations
+
+
+def unpublished_slots(
+        slots: Sequence[Tuple[datetime, datetime, float]],
+) -> List[Tuple[datetime, datetime]]:
+    """Return hourly slots from the end of the published prices to the next day's end."""
+    if not slots:
+        return []
+    end = slots[-1][1]
+    # Day-ahead prices always cover a whole day, so plan until the day after
+    # the published horizon ends
+    target = (end + timedelta(days=1)).replace(hour=0, minute=0, second=0, microsecond=0)
+    if end.hour == 0 and end.minute == 0:
+        target = end + timedelta(days=1)
+
+    future = []
+    start = end
+    while start < target:
+        future.append((start, start + timedelta(hours=1)))
+        start += timedelta(hours=1)
+    return future
+
+
+def generate_scenarios(
+        statistics: PriceStatistics,
+        area: str,
+        slots: Sequence[Tuple[datetime, datetime, float]],
+        future: Sequence[Tuple[datetime, datetime]],
+        count: int,
+        seed: int | None = None,
+) -> List[List[float]]:
+    """Sample price paths for the unpublished slots.
+
+    Prices follow the hourly mean and spread with AR(1) correlated deviations
+    that start from how far the last published price was from its hour's mean.
+    """
+    if not slots or not future or count <= 0:
+        return []
+
+    means, deviations = statistics.hourly(area, [price for _, _, price in slots])
+    last_start, _, last_price = slots[-1]
+    last_deviation = deviations[last_start.hour]
+    start_z = (last_price - means[last_start.hour]) / last_deviation if last_deviation > 0 else 0.0
+    noise = math.sqrt(1 - SCENARIO_CORRELATION ** 2)
+    rng = random.Random(seed)
+
+    scenarios = []
+    for _ in range(count):
+        z = start_z
+        prices = []
+        for start, _ in future:
+            z = SCENARIO_CORRELATION * z + noise * rng.gauss(0.0, 1.0)
+            prices.append(means[start.hour] + deviations[start.hour] * z)
+        scenarios.append(prices)
+    return scenarios
@@ -63,7 +63,9 @@ class BatteryPlannerSelectEntity(CoordinatorEntity, SelectEntity):
     @property
     def current_option(self):
         """Return the current selected option."""
-        return self._current_option
+        if self._param_id is None:
+            return self._current_option
+        return self.coordinator.params.get(self._param_id, self._current_option)
 
     async def async_select_option(self, option: str):
         """Change the selected option."""
@@ -11,13 +11,14 @@ from homeassistant.components.sensor import (
 )
 from homeassistant.config_entries import ConfigEntry
 from homeassistant.const import UnitOfPower
-from homeassistant.core import HomeAssistant
+from homeassistant.core import HomeAssistant, callback
 from homeassistant.helpers.entity import DeviceInfo
 from homeassistant.helpers.entity_platform import AddEntitiesCallback
 from homeassistant.helpers.typing import StateType
 from homeassistant.helpers.update_coordinator import CoordinatorEntity
 
 from . import DOMAIN, BatteryPlannerCoordinator
+from .loads import parse_loads
 
 _LOGGER = logging.getLogger(__name__)
 
@@ -34,7 +35,12 @@ async def async_setup_entry(
         BatteryPlannerPowerSensor(coordinator, entry),
         BatteryPlannerSavingsSensor(coordinator, entry),
         BatteryPlannerScheduleSensor(coordinator, entry),
+        BatteryPlannerStoredValueSensor(coordinator, entry),
     ]
+    entities.extend(
+        BatteryPlannerLoadSensor(coordinator, entry, load[0])
+        for load in parse_loads(coordinator.params["flexible_loads"])
+    )
 
     async_add_entities(entities)
 
@@ -62,6 +68,12 @@ class BatteryPlannerBaseSensor(CoordinatorEntity, SensorEntity):
             manufacturer="Stenite",
         )
 
+    @callback
+    def _handle_coordinator_update(self) -> None:
+        """Write the new state, timed when refresh profiling is enabled."""
+        with self.coordinator.profiler.span("sensor_state_write"):
+            super()._handle_coordinator_update()
+
 class BatteryPlannerActionSensor(BatteryPlannerBaseSensor):
     """Sensor for the current recommended battery action."""
 
@@ -81,7 +93,7 @@ class BatteryPlannerActionSensor(BatteryPlannerBaseSensor):
         """Return the current recommended action."""
         if not self.coordinator.data:
             return None
-        return self.coordinator.data.get("action_type")
+        return self.coordinator.data.action_type
 
 class BatteryPlannerPowerSensor(BatteryPlannerBaseSensor):
     """Sensor for the current recommended power setting."""
@@ -104,7 +116,7 @@ class BatteryPlannerPowerSensor(BatteryPlannerBaseSensor):
         """Return the current recommended power in watts."""
         if not self.coordinator.data:
             return None
-        return self.coordinator.data.get("watts")
+        return self.coordinator.data.watts
 
 class BatteryPlannerSavingsSensor(BatteryPlannerBaseSensor):
     """Sensor for tracking expected savings."""
@@ -124,15 +136,7 @@ class BatteryPlannerSavingsSensor(BatteryPlannerBaseSensor):
         """Return the expected savings as a float."""
         if not self.coordinator.data:
             return None
-
-        total_cost = self.coordinator.data.get("total_cost")
-        baseline_cost = self.coordinator.data.get("baseline_cost")
-
-        if total_cost is None or baseline_cost is None:
-            return None
-
-        # Convert the result to float
-        return float(baseline_cost - total_cost)
+        return self.coordinator.data.savings
 
     @property
     def extra_state_attributes(self) -> dict[str, Any]:
@@ -141,8 +145,8 @@ class BatteryPlannerSavingsSensor(BatteryPlannerBaseSensor):
             return {}
 
         return {
-            "baseline_cost": float(self.coordinator.data.get("baseline_cost", 0.0)),
-            "total_cost": float(self.coordinator.data.get("total_cost", 0.0)),
+            "baseline_cost": self.coordinator.data.baseline_cost,
+            "total_cost": self.coordinator.data.total_cost,
         }
 
 
@@ -164,17 +168,82 @@ class BatteryPlannerScheduleSensor(BatteryPlannerBaseSensor):
     @property
     def native_value(self) -> StateType:
         """Return a summary of the schedule."""
-        if not self.coordinator.data or "schedule" not in self.coordinator.data:
+        if not self.coordinator.data:
             return "No schedule"
-        return f"{len(self.coordinator.data['schedule'])} periods planned"
+        return f"{len(self.coordinator.data.schedule)} periods planned"
 
     @property
     def extra_state_attributes(self) -> dict[str, Any]:
         """Return minimal attributes."""
-        if not self.coordinator.data or "schedule" not in self.coordinator.data:
+        if not self.coordinator.data:
             return {}
 
-        schedule = self.coordinator.data.get("schedule", [])
         return {
-            "schedule": schedule,
-        }
\ No newline at end of file
+            "schedule": self.coordinator.data.schedule.periods(),
+        }
+
+class BatteryPlannerStoredValueSensor(BatteryPlannerBaseSensor):
+    """Sensor for the marginal value of energy stored in the battery."""
+
+    _unrecorded_attributes = frozenset({"forecast"})  # Changes with every plan
+
+    def __init__(
+            self,
+            coordinator: BatteryPlannerCoordinator,
+            entry: ConfigEntry,
+    ) -> None:
+        """Initialize the sensor."""
+        super().__init__(coordinator, entry)
+        self._attr_unique_id = f"{entry.entry_id}_stored_energy_value"
+        self._attr_name = "Stored Energy Value"
+
+    @property
+    def native_value(self) -> StateType:
+        """Return the value of one more kWh in the battery for the current slot."""
+        if not self.coordinator.stored_energy_value:
+            return None
+        return self.coordinator.stored_energy_value[0]["value"]
+
+    @property
+    def extra_state_attributes(self) -> dict[str, Any]:
+        """Return the per-slot forecast of the stored energy value."""
+        return {
+            "forecast": self.coordinator.stored_energy_value,
+        }
+
+class BatteryPlannerLoadSensor(BatteryPlannerBaseSensor):
+    """Sensor for the planned power of one flexible load."""
+
+    _unrecorded_attributes = frozenset({"schedule"})  # Changes with every plan
+
+    def __init__(
+            self,
+            coordinator: BatteryPlannerCoordinator,
+            entry: ConfigEntry,
+            load: str,
+    ) -> None:
+        """Initialize the sensor."""
+        super().__init__(coordinator, entry)
+        self._load = load
+        self._attr_unique_id = f"{entry.entry_id}_load_{load}"
+        self._attr_name = f"{load.replace('_', ' ').title()} Planned Power"
+        self._attr_device_class = SensorDeviceClass.POWER
+        self._attr_native_unit_of_measurement = UnitOfPower.KILO_WATT
+        self._attr_state_class = SensorStateClass.MEASUREMENT
+
+    @property
+    def native_value(self) -> StateType:
+        """Return the power the load should run at now."""
+        load = self.coordinator.load_schedules.get(self._load)
+        if not load:
+            return None
+        return load["power"]
+
+    @property
+    def extra_state_attributes(self) -> dict[str, Any]:
+        """Return the load's remaining energy, deadline and planned periods."""
+        load = self.coordinator.load_schedules.get(self._load)
+        if not load:
+            return {}
+
+        return {key: value for key, value in load.items() if key != "power"}
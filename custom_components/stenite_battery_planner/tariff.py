@@ -0,0 +1,121 @@
+"""Time-of-use grid tariffs for Stenite Battery Planner."""
+from __future__ import annotations
+
+from datetime import datetime, tzinfo
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+WEEKDAYS = ["mon", "tue", "wed", "thu", "fri", "sat", "sun"]
+
+
+def _parse_days(text: str) -> Tuple[int, ...]:
+    """Parse ``mon``, ``mon-fri`` or ``sat+sun`` into weekday numbers."""
+    days = []
+    for part in text.split("+"):
+        if "-" in part:
+            first, last = part.split("-")
+            first_index, last_index = WEEKDAYS.index(first), WEEKDAYS.index(last)
+            if last_index < first_index:
+                raise ValueError(f"Invalid day range: {part}")
+            days.extend(range(first_index, last_index + 1))
+        else:
+            days.append(WEEKDAYS.index(part))
+    return tuple(sorted(set(days)))
+
+
+def parse_tariff(text: Any) -> Tuple[Tuple[Tuple[int, ...], int, int, float], ...]:
+    """Parse a ``days start-end:rate, ...`` rate table.
+
+    For example ``mon-fri 6-22:0.55, sat+sun 0-24:0.25``. Hours are local and
+    the end hour is exclusive. An empty value means no table. Raises
+    ValueError on malformed rules.
+    """
+    if not text:
+        return ()
+    rules = []
+    for rule in str(text).split(","):
+        rule = rule.strip().lower()
+        if not rule:
+            continue
+        try:
+            days, window = rule.split()
+            hours, rate = window.split(":")
+            start, end = (int(hour) for hour in hours.split("-"))
+            parsed = (_parse_days(days), start, end, float(rate))
+        except ValueError as err:
+            raise ValueError(f"Invalid tariff rule: {rule}") from err
+        if not 0 <= start < end <= 24:
+            raise ValueError(f"Invalid tariff hours: {rule}")
+        rules.append(parsed)
+    return tuple(rules)
+
+
+class TimeOfUseTariff:
+    """Grid energy rates by weekday and hour, plus an optional peak power fee.
+
+    Hours not covered by the rate table use the flat network charge. The
+    table is expanded into a 7 x 24 grid once, so looking up the rate of a
+    slot is a single index.
+    """
+
+    def __init__(
+            self,
+            rules: Sequence[Tuple[Tuple[int, ...], int, int, float]],
+            base_rate: float,
+            time_zone: tzinfo,
+    ) -> None:
+        """Initialize."""
+        self._time_zone = time_zone
+        self._grid = [[base_rate] * 24 for _ in WEEKDAYS]
+        # Later rules take precedence over earlier ones
+        for days, start, end, rate in rules:
+            for day in days:
+                for hour in range(start, end):
+                    self._grid[day][hour] = rate
+        self._cache: Dict[Tuple, List[float]] = {}
+
+    def rate(self, time: datetime) -> float:
+        """Return the grid energy rate at the given time."""
+        local = time.astimezone(self._time_zone)
+        return self._grid[local.weekday()][local.hour]
+
+    def slot_rates(self, slots: Sequence[Tuple[datetime, ...]]) -> List[float]:
+        """Return the rate per slot, computed once per horizon."""
+        if not slots:
+            return []
+        key = (slots[0][0], slots[-1][1], len(slots))
+        rates = self._cache.get(key)
+        if rates is None:
+            if len(self._cache) >= 4:
+                self._cache.clear()
+            rates = self._cache[key] = [self.rate(slot[0]) for slot in slots]
+        return rates
+
+
+class MonthlyPeak:
+    """The highest grid import power seen in the current month."""
+
+    def __init__(self, data: Dict[str, Any] | None = None) -> None:
+        """Initialize from previously stored data."""
+        data = data or {}
+        self.month: Optional[str] = data.get("month")
+        self.peak: float = float(data.get("peak", 0.0))
+
+    def as_dict(self) -> Dict[str, Any]:
+        """Return the peak in a storable format."""
+        return {"month": self.month, "peak": self.peak}
+
+    def current(self, time: datetime) -> float:
+        """Return the peak of the month the given time falls in."""
+        return self.peak if self.month == f"{time.year}-{time.month:02d}" else 0.0
+
+    def observe(self, time: datetime, power: float) -> bool:
+        """Record an import power, returning whether the peak changed."""
+        month = f"{time.year}-{time.month:02d}"
+        changed = month != self.month
+        if changed:
+            self.month = month
+            self.peak = 0.0
+        if power > self.peak:
+            self.peak = power
+            changed = True
+        return changed
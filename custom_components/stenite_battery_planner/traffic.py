@@ -0,0 +1,114 @@
+"""Record and replay planner API traffic for Stenite Battery Planner."""
+from __future__ import annotations
+
+import gzip
+import json
+from datetime import datetime
+from typing import Any, Dict, List, Tuple
+
+TRAFFIC_MODES = ["off", "record", "replay"]
+
+
+def _payload_key(payload: Dict[str, Any]) -> str:
+    """Return a canonical form of a payload used to match recorded requests."""
+    return json.dumps(payload, sort_keys=True, separators=(",", ":"), default=str)
+
+
+class TrafficRecorder:
+    """Append planner requests and responses to a gzipped JSON lines log.
+
+    Every entry is written as its own gzip member, so the log stays readable
+    if Home Assistant stops halfway through a write and can be appended to
+    without rewriting it. Writes block, so run them in the executor.
+    """
+
+    def __init__(self, path: str) -> None:
+        """Initialize."""
+        self.path = path
+        self.recorded = 0
+
+    def append(
+            self,
+            time: datetime,
+            payload: Dict[str, Any],
+            status: int,
+            body: bytes,
+            elapsed: float,
+    ) -> None:
+        """Write one request/response pair with its round trip time in seconds."""
+        entry = {
+            "time": time.isoformat(),
+            "elapsed": round(elapsed, 4),
+            "payload": payload,
+            "status": status,
+            "body": body.decode(errors="replace"),
+        }
+        line = json.dumps(entry, separators=(",", ":"), default=str) + "\n"
+        with gzip.open(self.path, "at", encoding="utf-8") as log:
+            log.write(line)
+        self.recorded += 1
+
+
+def load_traffic(path: str) -> List[Dict[str, Any]]:
+    """Read a recorded traffic log. Raises OSError or ValueError if it is unusable."""
+    entries = []
+    with gzip.open(path, "rt", encoding="utf-8") as log:
+        for number, line in enumerate(log, 1):
+            if not line.strip():
+                continue
+            entry = json.loads(line)
+            if not isinstance(entry, dict) or not {"payload", "status", "body"} <= entry.keys():
+                raise ValueError(f"Line {number} is not a recorded request")
+            entries.append(entry)
+    return entries
+
+
+class TrafficReplay:
+    """Serve recorded responses in place of the planner API.
+
+    A request is answered with a recorded response to the same payload when
+    there is one, otherwise with the next recorded response in log order, so
+    a live install that never repeats a payload still walks through the
+    recording deterministically.
+    """
+
+    def __init__(self, entries: List[Dict[str, Any]], latency_scale: float = 1.0) -> None:
+        """Initialize."""
+        if not entries:
+            raise ValueError("Traffic log has no recorded requests")
+        self._entries = entries
+        self.latency_scale = latency_scale
+        self._by_payload: Dict[str, List[int]] = {}
+        for index, entry in enumerate(entries):
+            self._by_payload.setdefault(_payload_key(entry["payload"]), []).append(index)
+        self._matched: Dict[str, int] = {}
+        self._cursor = 0
+        self.served = 0
+        self.misses = 0
+
+    def __len__(self) -> int:
+        """Return the number of recorded requests."""
+        return len(self._entries)
+
+    def response(self, payload: Dict[str, Any]) -> Tuple[int, bytes, float]:
+        """Return the status, body and scaled delay to answer a request with."""
+        key = _payload_key(payload)
+        matches = self._by_payload.get(key)
+        if matches:
+            # Repeated identical requests cycle through their recorded answers
+            count = self._matched.get(key, 0)
+            self._matched[key] = count + 1
+            entry = self._entries[matches[count % len(matches)]]
+        else:
+            self.misses += 1
+            entry = self._entries[self._cursor]
+            self._cursor = (self._cursor + 1) % len(self._entries)
+
+        self.served += 1
+        delay = float(entry.get("elapsed", 0.0)) * self.latency_scale
+        return int(entry["status"]), entry["body"].encode(), delay
+
+    def summary(self) -> Dict[str, Any]:
+        """Return replay counters."""
+        return {"entries": len(self._entries), "served": self.served, "misses": self.misses}
+